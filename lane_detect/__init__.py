@@ -1,3 +1,10 @@
 from .util import LaneFilter
+from .pipeline import LanePipeline
+from .adaptive import AdaptivePipeline
+from .track import LaneTracker
+from .parallel import FramePool
+from .stream import VideoStream
+from .results import ResultsWriter, ResultsReader
 from .plot import show_image
-from .log import logger, set_debug_flag
+from .stats import RunStats, profile
+from .log import logger, diagnostics, set_debug_flag
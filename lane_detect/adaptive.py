@@ -0,0 +1,182 @@
+from collections import Counter
+from time import perf_counter, sleep
+from numpy import ndarray
+from cv2 import COLOR_RGB2GRAY
+from lane_detect.pipeline import LanePipeline
+from lane_detect.log import logger
+
+
+# deadline control
+BUDGET_MS         = 33.0  # per frame, ~30 fps
+EMA_WEIGHT        = 0.2   # weight of the newest frame time
+SETTLE_FRAMES     = 5     # frames at a level before its time is trusted
+RECOVER_AFTER     = 30    # frames with headroom before stepping back up
+MAX_RECOVER_AFTER = 960   # recoveries that fail quickly back off up to this
+HEADROOM          = 0.7   # step up when frames take under this fraction of the budget
+# quality ladder, cheapest last: processing scale relative to the pipeline's, crop to the ROI box,
+# and detect every nth frame, reusing the last lanes in between
+QUALITY_LEVELS = (
+    {'scale': 1.0,  'crop': False, 'every': 1},
+    {'scale': 0.75, 'crop': False, 'every': 1},
+    {'scale': 0.5,  'crop': False, 'every': 1},
+    {'scale': 0.5,  'crop': True,  'every': 1},
+    {'scale': 0.5,  'crop': True,  'every': 2},
+    {'scale': 0.5,  'crop': True,  'every': 3},
+    {'scale': 0.5,  'crop': True,  'every': 4}
+)
+
+
+class AdaptivePipeline(object):
+    def __init__(self, budget_ms=BUDGET_MS, levels=QUALITY_LEVELS, pace=False, recover_after=RECOVER_AFTER,
+                 headroom=HEADROOM, **pipeline_kwargs):
+        '''
+        AdaptivePipeline holds lane detection to a per-frame time budget for live feeds.
+        It measures every frame, and while the smoothed frame time misses the budget it steps
+        down the quality ladder: downscaling, then cropping to the ROI box, then detecting only
+        every nth frame and overlaying the last lanes in between. With headroom it steps back
+        up, waiting longer after each step up that had to be undone.
+        :param budget_ms: float milliseconds per frame
+        :param levels: quality ladder, see QUALITY_LEVELS
+        :param pace: bool hold each output until its slot, so frames leave every budget_ms
+        :param recover_after: int frames with headroom before stepping up
+        :param headroom: float fraction of the budget frames must stay under to step up
+        :param pipeline_kwargs: LanePipeline parameters of full quality
+        '''
+        self.budget_ms = budget_ms
+        self.levels = levels
+        self.pace = pace
+        self.recover_after = recover_after
+        self.headroom = headroom
+        self.pipeline_kwargs = pipeline_kwargs
+        self.color_order = pipeline_kwargs.get('color_order', COLOR_RGB2GRAY)
+        self.pipelines = [None] * len(levels)
+        self.level = 0
+        self.frames = 0
+        self.degraded = 0  # detected below full quality
+        self.dropped = 0   # not detected, last lanes reused
+        self.late = 0      # over budget
+        self.level_frames = Counter()
+        self._ema = None
+        self._at_level = 0
+        self._since_detect = 0
+        self._last = None
+        self._recover_after = recover_after
+        self._recovered_at = None
+        self._next_slot = None
+
+    def get_pipeline(self, level: int) -> LanePipeline:
+        '''
+        LanePipeline of a quality level, created on first use
+        :param level: int index into levels
+        :return: <LanePipeline>
+        '''
+        pipeline = self.pipelines[level]
+        if pipeline is None:
+            _level = self.levels[level]
+            _kwargs = dict(self.pipeline_kwargs)
+            # a set scale would override target_width, see LaneFilter.set_scale()
+            if _kwargs.get('target_width'):
+                _kwargs['target_width'] = int(_kwargs['target_width'] * _level['scale'])
+            else:
+                _kwargs['scale'] = (_kwargs.get('scale') or 1.0) * _level['scale']
+            _kwargs['crop'] = _kwargs.get('crop', False) or _level['crop']
+            pipeline = LanePipeline(**_kwargs)
+            self.pipelines[level] = pipeline
+        return pipeline
+
+    def process(self, frame: ndarray) -> ndarray:
+        '''
+        Runs the pipeline on a frame at the current quality level.
+        The returned image is a reused buffer, see LanePipeline.process().
+        :param frame: <numpy.ndarray> input frame
+        :return: <numpy.ndarray> frame with lane overlay
+        '''
+        _t = perf_counter()
+        level = self.level
+        lane = None
+        if self._last is not None and self._since_detect + 1 < self.levels[level]['every']:
+            lane = self._last.redraw(frame)
+        if lane is None:
+            self._last = self.get_pipeline(level)
+            filter = self._last.detect(frame)
+            lane = filter.weighted_image()
+            self._since_detect = 0
+            if level:
+                self.degraded = self.degraded + 1
+        else:
+            self._since_detect = self._since_detect + 1
+            self.dropped = self.dropped + 1
+            if self._last.results is not None:
+                # no segments or stage times, nothing was detected
+                filter = self._last.sessions[frame.shape]
+                self._last.results.append_lanes(filter.left_lane, filter.right_lane,
+                                                ms=(perf_counter() - _t) * 1000)
+        self.frames = self.frames + 1
+        self.level_frames[level] += 1
+        self._adapt((perf_counter() - _t) * 1000)
+        if self.pace:
+            self._wait_for_slot()
+        return lane
+
+    def _adapt(self, ms: float):
+        '''
+        Updates the smoothed frame time and steps the quality level
+        :param ms: float frame time in milliseconds
+        '''
+        if ms > self.budget_ms:
+            self.late = self.late + 1
+        self._at_level = self._at_level + 1
+        # the first frame at a level pays for allocating its buffers
+        if self._at_level == 1:
+            return
+        self._ema = ms if self._ema is None else EMA_WEIGHT * ms + (1 - EMA_WEIGHT) * self._ema
+        if self._at_level < SETTLE_FRAMES:
+            return
+        if self._ema > self.budget_ms and self.level + 1 < len(self.levels):
+            if self._recovered_at is not None and self.frames - self._recovered_at < self._recover_after:
+                self._recover_after = min(self._recover_after * 2, MAX_RECOVER_AFTER)
+            else:
+                self._recover_after = self.recover_after
+            self._recovered_at = None
+            self._set_level(self.level + 1)
+        elif self._ema < self.budget_ms * self.headroom and self.level and self._at_level >= self._recover_after:
+            self._recovered_at = self.frames
+            self._set_level(self.level - 1)
+
+    def _set_level(self, level: int):
+        logger.debug('frame %d: %.1f ms over %.1f ms budget, quality level %d -> %d %s',
+                     self.frames, self._ema, self.budget_ms, self.level, level, self.levels[level])
+        self.level = level
+        self._at_level = 0
+        self._ema = None
+
+    def _wait_for_slot(self):
+        '''
+        Holds the output until the next budget_ms slot, a late frame restarts the schedule
+        so outputs never bunch up to catch up
+        '''
+        _now = perf_counter()
+        if self._next_slot is None or _now > self._next_slot:
+            self._next_slot = _now + self.budget_ms / 1000
+            return
+        sleep(self._next_slot - _now)
+        self._next_slot = self._next_slot + self.budget_ms / 1000
+
+    def summary(self) -> dict:
+        '''
+        :return: <dict> {frames, degraded, dropped, late, level, levels: {level: frames}}
+        '''
+        return {
+            'frames': self.frames,
+            'degraded': self.degraded,
+            'dropped': self.dropped,
+            'late': self.late,
+            'level': self.level,
+            'levels': dict(sorted(self.level_frames.items()))
+        }
+
+    def log_summary(self):
+        _summary = self.summary()
+        logger.info('%d frames within %.1f ms: %d degraded, %d dropped (last lanes reused), %d late, '
+                    'frames per quality level %s', _summary['frames'], self.budget_ms, _summary['degraded'],
+                    _summary['dropped'], _summary['late'], _summary['levels'])
@@ -0,0 +1,250 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from glob import glob
+from multiprocessing import get_context
+from multiprocessing.util import Finalize
+from os import listdir, makedirs
+from os.path import isdir, isfile, join, basename
+from threading import BoundedSemaphore, local
+from time import perf_counter
+from numpy import ndarray
+from cv2 import imread, imwrite, cvtColor, COLOR_BGR2RGB, COLOR_RGB2BGR
+from lane_detect.pipeline import LanePipeline
+from lane_detect.line_math import get_segments
+from lane_detect.log import logger
+
+
+# stage output prefixes, same as test-lane-detect --save-images
+STAGES = ('begin', 'gaussian', 'canny', 'hough', 'roi', 'end')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+WRITERS = 4
+MAX_PENDING_WRITES = 64
+
+# per thread (or per process) pipelines, see _get_pipeline()
+_local = local()
+
+
+def expand_inputs(paths: list) -> list:
+    '''
+    Expands directories and glob patterns into image files
+    :param paths: list of str files, directories or globs
+    :return: <list> sorted unique file paths
+    '''
+    _files = set()
+    for _path in paths:
+        if isdir(_path):
+            _files.update(join(_path, _f) for _f in listdir(_path)
+                          if _f.lower().endswith(IMAGE_EXTENSIONS))
+        elif isfile(_path):
+            _files.add(_path)
+        else:
+            _matches = [_f for _f in glob(_path, recursive=True) if isfile(_f)]
+            if not _matches:
+                logger.warning('%s matched no files', _path)
+            _files.update(_matches)
+    return sorted(_files)
+
+
+def _get_pipeline(pipeline_kwargs: dict) -> LanePipeline:
+    if getattr(_local, 'pipeline', None) is None:
+        _local.pipeline = LanePipeline(**pipeline_kwargs)
+    return _local.pipeline
+
+
+def run_stages(pipeline: LanePipeline, image: ndarray, stages=()) -> (object, dict):
+    '''
+    Runs the pipeline step by step, capturing copies of the selected stage outputs
+    :param pipeline: <LanePipeline>
+    :param image: <numpy.ndarray> RGB image
+    :param stages: names from STAGES to capture
+    :return: <tuple> (filter: LaneFilter, captured: dict {stage: ndarray})
+    '''
+    captured = {}
+    filter = pipeline.get_filter(image)
+    if 'begin' in stages:
+        captured['begin'] = filter.image
+    filter.gaussian_blur()
+    if 'gaussian' in stages:
+        captured['gaussian'] = filter.image_tf.copy()
+    filter.canny_edges(pipeline.canny_lower, pipeline.canny_upper)
+    if 'canny' in stages:
+        captured['canny'] = filter.image_tf.copy()
+    filter.hough_lines(rho=pipeline.rho, threshold=pipeline.threshold,
+                       min_line_len=pipeline.min_line_len, max_line_gap=pipeline.max_line_gap,
+                       theta=pipeline.theta, with_lines=True)
+    if 'hough' in stages:
+        captured['hough'] = filter.image_tf.copy()
+    filter.apply_roi_mask()
+    if 'roi' in stages:
+        captured['roi'] = filter.image_tf.copy()
+    filter.weighted_image()
+    if 'end' in stages:
+        captured['end'] = filter.lane.copy()
+    return filter, captured
+
+
+def write_image(filename: str, image: ndarray) -> bool:
+    '''
+    Writes an RGB or single channel image with OpenCV
+    :param filename: str output path
+    :param image: <numpy.ndarray>
+    :return: True if written
+    '''
+    if image.ndim > 2:
+        image = cvtColor(image, COLOR_RGB2BGR)
+    if not imwrite(filename, image):
+        logger.error('could not write %s', filename)
+        return False
+    return True
+
+
+def lane_to_list(lane: ndarray):
+    if lane is None:
+        return None
+    return lane.tolist()
+
+
+def process_file(filename: str, output_dir=None, stages=(), pipeline_kwargs=None, writer=None) -> dict:
+    '''
+    Detects lanes in one image file, queueing the selected stage outputs for writing
+    :param filename: str image path
+    :param output_dir: str directory for stage outputs
+    :param stages: names from STAGES to write
+    :param pipeline_kwargs: dict LanePipeline parameters
+    :param writer: <ThreadPoolExecutor> background writers, writes are awaited here when None
+    :return: <dict> {file, left_lane, right_lane, segments, segments_dominant, segments_kept, ms, writes: [futures]},
+             {file, error, ms, writes: []} if the image could not be read or detected
+    '''
+    _t = perf_counter()
+    _result = {'file': filename, 'left_lane': None, 'right_lane': None,
+               'segments': 0, 'segments_dominant': 0, 'segments_kept': 0, 'writes': []}
+    try:
+        image = imread(filename)
+        if image is None:
+            raise RuntimeError('could not read {0}'.format(filename))
+        image = cvtColor(image, COLOR_BGR2RGB, dst=image)
+        filter, captured = run_stages(_get_pipeline(pipeline_kwargs or {}), image, stages)
+    except Exception as err:
+        # one bad image must not abort a batch
+        return {'file': filename, 'error': str(err), 'ms': (perf_counter() - _t) * 1000, 'writes': []}
+    _result['left_lane'] = lane_to_list(filter.left_lane)
+    _result['right_lane'] = lane_to_list(filter.right_lane)
+    _result['segments'] = len(get_segments(filter.lines))
+    _result['segments_dominant'] = len(filter.roi_filter_lines)
+    _result['segments_kept'] = len(filter.slope_filter_lines)
+    _name = basename(filename)
+    for _stage, _image in captured.items():
+        _output = join(output_dir, '{0}_{1}'.format(_stage, _name))
+        if writer is None:
+            write_image(_output, _image)
+        else:
+            _result['writes'].append(writer.submit(write_image, _output, _image))
+    _result['ms'] = (perf_counter() - _t) * 1000
+    return _result
+
+
+def process_file_bounded(filename: str, output_dir: str, stages: tuple, pipeline_kwargs: dict,
+                         writer: ThreadPoolExecutor, pending: BoundedSemaphore) -> dict:
+    '''
+    process_file() without waiting for its writes, each stage output holds a pending slot
+    until it is written, so queued writes hold a bounded number of images
+    :param pending: <BoundedSemaphore> pending write slots
+    :return: <dict> process_file() result without writes
+    '''
+    for _ in stages:
+        pending.acquire()
+    _result = process_file(filename, output_dir, stages, pipeline_kwargs, writer)
+    _writes = _result.pop('writes')
+    for _ in range(len(stages) - len(_writes)):
+        pending.release()
+    for _future in _writes:
+        _future.add_done_callback(lambda _f: pending.release())
+    return _result
+
+
+def _init_worker(writers: int, max_pending: int):
+    '''
+    Process pool initializer, stage outputs are written by the worker's own writer threads,
+    which are drained once when the worker exits at pool shutdown
+    '''
+    _local.writer = ThreadPoolExecutor(max_workers=writers, thread_name_prefix='lane-write')
+    _local.pending = BoundedSemaphore(max_pending)
+    Finalize(None, _local.writer.shutdown, kwargs={'wait': True}, exitpriority=10)
+
+
+def _process_file_in_worker(filename: str, output_dir: str, stages: tuple, pipeline_kwargs: dict) -> dict:
+    '''
+    Process pool task, returns once detection is done, see _init_worker()
+    '''
+    return process_file_bounded(filename, output_dir, stages, pipeline_kwargs, _local.writer, _local.pending)
+
+
+class BatchRunner(object):
+    def __init__(self, jobs=1, writers=WRITERS, output_dir=None, stages=(),
+                 use_processes=False, **pipeline_kwargs):
+        '''
+        BatchRunner detects lanes in many images in parallel.
+        Stage outputs are written by a background writer pool.
+        :param jobs: int parallel detections
+        :param writers: int parallel image writers
+        :param output_dir: str directory for stage outputs, required when stages are selected
+        :param stages: names from STAGES to write
+        :param use_processes: bool process pool instead of thread pool
+        :param pipeline_kwargs: LanePipeline parameters
+        '''
+        unknown = set(stages) - set(STAGES)
+        assert not unknown, 'unknown stages {0}, choose from {1}'.format(sorted(unknown), STAGES)
+        assert output_dir or not stages, 'output_dir is required to save stages'
+        self.jobs = jobs
+        self.writers = writers
+        self.output_dir = output_dir
+        self.stages = tuple(stages)
+        self.use_processes = use_processes
+        self.pipeline_kwargs = pipeline_kwargs
+
+    def _run_threads(self, files: list):
+        # limits images held by queued writes, every detection can always take its share
+        pending = BoundedSemaphore(max(MAX_PENDING_WRITES, self.jobs * len(self.stages)))
+
+        def _task(filename):
+            return process_file_bounded(filename, self.output_dir, self.stages, self.pipeline_kwargs, writer, pending)
+
+        with ThreadPoolExecutor(max_workers=self.writers, thread_name_prefix='lane-write') as writer, \
+                ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='lane-detect') as executor:
+            for _result in executor.map(_task, files):
+                yield _result
+
+    def _run_processes(self, files: list):
+        with ProcessPoolExecutor(max_workers=self.jobs, mp_context=get_context('spawn'), initializer=_init_worker,
+                                 initargs=(self.writers, max(MAX_PENDING_WRITES, len(self.stages)))) as executor:
+            _futures = [executor.submit(_process_file_in_worker, _f, self.output_dir,
+                                        self.stages, self.pipeline_kwargs) for _f in files]
+            for _f, _future in zip(files, _futures):
+                try:
+                    yield _future.result()
+                except Exception as err:
+                    yield {'file': _f, 'error': str(err), 'ms': 0.0}
+
+    def run(self, paths: list):
+        '''
+        Processes all images, yielding per image results in input order
+        :param paths: list of str files, directories or globs
+        :return: generator of <dict> {file, left_lane, right_lane, ms}, or {file, error, ms}
+        '''
+        files = expand_inputs(paths)
+        logger.info('processing %d images with %d %s', len(files), self.jobs,
+                    'processes' if self.use_processes else 'threads')
+        if self.stages and not isdir(self.output_dir):
+            makedirs(self.output_dir)
+        _t = perf_counter(); _count = 0; _lanes = 0; _failed = 0
+        _run = self._run_processes if self.use_processes else self._run_threads
+        for _result in _run(files):
+            _count = _count + 1
+            if 'error' in _result:
+                _failed = _failed + 1
+                logger.error('%s failed: %s', _result['file'], _result['error'])
+            else:
+                _lanes = _lanes + (_result['left_lane'] is not None) + (_result['right_lane'] is not None)
+            yield _result
+        _elapsed = perf_counter() - _t
+        logger.info('%d images in %.2f s, %.1f images/sec, %d lanes found, %d failed',
+                    _count, _elapsed, _count / _elapsed if _elapsed else 0.0, _lanes, _failed)
@@ -0,0 +1,262 @@
+import json
+from os import listdir, environ, pathsep
+from os.path import join, isdir, dirname, abspath
+from subprocess import check_output
+from sys import executable
+from time import perf_counter
+from platform import python_version
+from numpy import ndarray, array, percentile, uint8, int32, full
+from numpy.random import RandomState
+from cv2 import imread, cvtColor, fillPoly, line, add, COLOR_BGR2RGB, __version__ as cv2_version
+from lane_detect.util import LaneFilter
+from lane_detect.line_math import find_dominate_signals, find_mean_slope, interpolate_dominate_lines
+from lane_detect.lane_fit import fit_lanes
+from lane_detect.pipeline import CANNY_LOWER_BOUND, CANNY_UPPER_BOUND, \
+    HOUGH_RHO, HOUGH_THRESH, HOUGH_LINE_LEN, HOUGH_LINE_GAP
+from lane_detect.log import logger
+
+
+RESOLUTIONS = {
+    '480p': (854, 480),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160)
+}
+# top level stages add up to 'total', line_math sub-steps are timed within draw_lines
+STAGES = ('grayscale', 'gaussian_blur', 'canny_edges', 'hough_lines', 'draw_lines',
+          'apply_roi_mask', 'weighted_image')
+SUB_STAGES = ('find_dominate_signals', 'find_mean_slope', 'interpolate_dominate_lines', 'fit_lanes')
+PERCENTILES = (50, 90, 99)
+REPEAT = 20
+WARMUP = 3
+REGRESSION_THRESH = 0.15
+REGRESSION_MIN_MS = 0.05  # ignore slowdowns below timer noise
+# cold start, each run imports the package in a fresh interpreter
+STARTUP_MODULE  = 'lane_detect'
+STARTUP_REPEAT  = 5
+STARTUP_EXCLUDE = ('matplotlib', 'moviepy')  # must load only when used
+STARTUP_MIN     = {'import_ms': 5.0, 'rss_mb': 2.0}  # ignore regressions below noise
+_STARTUP_SCRIPT = '''
+import json, sys
+from resource import getrusage, RUSAGE_SELF
+from time import perf_counter
+_t = perf_counter()
+__import__(sys.argv[1])
+_t = perf_counter() - _t
+_rss = getrusage(RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+print(json.dumps({'import_ms': _t * 1000, 'rss_mb': _rss, 'modules': sorted({_m.split('.')[0] for _m in sys.modules})}))
+'''
+
+
+def make_synthetic_frame(width: int, height: int, seed=0) -> ndarray:
+    '''
+    Road-like RGB frame: noisy pavement with a solid and a dashed lane line
+    :param width: int frame width
+    :param height: int frame height
+    :param seed: int noise seed
+    :return: <numpy.ndarray>
+    '''
+    frame = full((height, width, 3), 90, dtype=uint8)
+    fillPoly(frame, [array([(0, height // 2), (width - 1, height // 2),
+                            (width - 1, 0), (0, 0)], dtype=int32)], (140, 170, 210))
+    thickness = max(2, width // 160)
+    horizon = (width // 2, int(height * 0.58))
+    line(frame, (int(width * 0.12), height - 1), horizon, (230, 230, 230), thickness)
+    x_bottom, y_bottom = int(width * 0.88), height - 1
+    for _start in (0.0, 0.25, 0.5, 0.75):
+        _dash = [(int(x_bottom + (horizon[0] - x_bottom) * _t), int(y_bottom + (horizon[1] - y_bottom) * _t))
+                 for _t in (_start, _start + 0.15)]
+        line(frame, _dash[0], _dash[1], (220, 200, 60), thickness)
+    noise = RandomState(seed).randint(0, 24, size=frame.shape, dtype=uint8)
+    return add(frame, noise)
+
+
+def load_inputs(image_dir=None, sizes=tuple(RESOLUTIONS)) -> dict:
+    '''
+    Benchmark inputs from an image directory plus synthetic frames
+    :param image_dir: str directory of images, skipped if None
+    :param sizes: names from RESOLUTIONS
+    :return: <dict> {name: RGB frame}
+    '''
+    _inputs = {}
+    if image_dir and isdir(image_dir):
+        for _f in sorted(listdir(image_dir)):
+            _image = imread(join(image_dir, _f))
+            if _image is None:
+                logger.warning('skipping %s, not an image', _f)
+                continue
+            _inputs[_f] = cvtColor(_image, COLOR_BGR2RGB)
+    for _size in sizes:
+        _inputs['synthetic_{0}'.format(_size)] = make_synthetic_frame(*RESOLUTIONS[_size])
+    return _inputs
+
+
+def time_stages(frame: ndarray, repeat=REPEAT, warmup=WARMUP) -> dict:
+    '''
+    Times every LaneFilter stage on frame
+    :param frame: <numpy.ndarray> RGB frame
+    :param repeat: int timed runs
+    :param warmup: int untimed runs
+    :return: <dict> {stage: [seconds, ...]}
+    '''
+    filter = LaneFilter(image=frame)
+    samples = {_stage: [] for _stage in STAGES + SUB_STAGES + ('total',)}
+    for _run in range(warmup + repeat):
+        _times = {}
+        filter.load_image(frame)
+        _t = perf_counter()
+        filter.grayscale()
+        _times['grayscale'] = perf_counter() - _t
+        _t = perf_counter()
+        filter.gaussian_blur()
+        _times['gaussian_blur'] = perf_counter() - _t
+        _t = perf_counter()
+        filter.canny_edges(CANNY_LOWER_BOUND, CANNY_UPPER_BOUND)
+        _times['canny_edges'] = perf_counter() - _t
+        _t = perf_counter()
+        lines = filter.hough_lines(rho=HOUGH_RHO, threshold=HOUGH_THRESH,
+                                   min_line_len=HOUGH_LINE_LEN, max_line_gap=HOUGH_LINE_GAP,
+                                   with_lines=False)
+        _times['hough_lines'] = perf_counter() - _t
+        _t = perf_counter()
+        filter.draw_lines(lines)
+        _times['draw_lines'] = perf_counter() - _t
+        _times.update(time_line_math(filter, lines))
+        _t = perf_counter()
+        filter.apply_roi_mask()
+        _times['apply_roi_mask'] = perf_counter() - _t
+        _t = perf_counter()
+        filter.weighted_image()
+        _times['weighted_image'] = perf_counter() - _t
+        _times['total'] = sum(_times[_stage] for _stage in STAGES)
+        if _run >= warmup:
+            for _stage in _times:
+                samples[_stage].append(_times[_stage])
+    return samples
+
+
+def time_line_math(filter: LaneFilter, lines: ndarray) -> dict:
+    '''
+    Re-runs the draw_lines line_math sub-steps on lines, timing each
+    :param filter: <LaneFilter> after draw_lines
+    :param lines: <numpy.ndarray> hough segments
+    :return: <dict> {sub stage: seconds}
+    '''
+    _times = {}
+    region_mask = filter.get_roi_mask()[..., 0]
+    lower_bound, upper_bound = filter.get_lane_bounds()
+    horizontal_limit = filter.image.shape[1] - 1
+    _t = perf_counter()
+    signals, mean_slope = find_dominate_signals(lines, region_mask)
+    _times['find_dominate_signals'] = perf_counter() - _t
+    _t = perf_counter()
+    mean_slope = find_mean_slope(signals, mean_slope)
+    _times['find_mean_slope'] = perf_counter() - _t
+    _t = perf_counter()
+    signals = interpolate_dominate_lines(signals, mean_slope, lower_bound, upper_bound, horizontal_limit)
+    _times['interpolate_dominate_lines'] = perf_counter() - _t
+    _t = perf_counter()
+    fit_lanes(signals, lower_bound, upper_bound, method=filter.fit_method)
+    _times['fit_lanes'] = perf_counter() - _t
+    return _times
+
+
+def summarize(samples: list) -> dict:
+    '''
+    Summarizes stage timings
+    :param samples: list of seconds
+    :return: <dict> {p50, p90, p99, mean (milliseconds), fps}
+    '''
+    _ms = array(samples) * 1000
+    _ret = {'p{0}'.format(_p): float(percentile(_ms, _p)) for _p in PERCENTILES}
+    _ret['mean'] = float(_ms.mean())
+    _ret['fps'] = 1000 / _ret['mean'] if _ret['mean'] else 0.0
+    return _ret
+
+
+def run_benchmark(image_dir=None, sizes=tuple(RESOLUTIONS), repeat=REPEAT, warmup=WARMUP) -> dict:
+    '''
+    Benchmarks all inputs
+    :return: <dict> {'meta': {...}, 'results': {input: {stage: summary}}}
+    '''
+    results = {}
+    for _name, _frame in load_inputs(image_dir, sizes).items():
+        samples = time_stages(_frame, repeat, warmup)
+        results[_name] = {_stage: summarize(samples[_stage]) for _stage in samples}
+        logger.info('%-28s %4dx%-4d total p50: %8.3f ms, %7.1f fps', _name, _frame.shape[1], _frame.shape[0],
+                    results[_name]['total']['p50'], results[_name]['total']['fps'])
+    return {
+        'meta': {
+            'python': python_version(),
+            'opencv': cv2_version,
+            'repeat': repeat,
+            'warmup': warmup
+        },
+        'results': results
+    }
+
+
+def time_startup(module=STARTUP_MODULE, repeat=STARTUP_REPEAT, exclude=STARTUP_EXCLUDE) -> dict:
+    '''
+    Benchmarks the cold start of short-lived workers: import time and peak RSS of a fresh
+    interpreter importing module, and which of the excluded packages it loaded
+    :param module: str module imported
+    :param repeat: int fresh interpreters
+    :param exclude: packages that should not load on import
+    :return: <dict> {module, import_ms: {p50, p90, p99, mean}, rss_mb: {...}, loaded: [excluded packages loaded]}
+    '''
+    # the package this benchmark belongs to, wherever it is run from
+    _path = dirname(dirname(abspath(__file__)))
+    _env = dict(environ, PYTHONPATH=pathsep.join(filter(None, (_path, environ.get('PYTHONPATH')))))
+    _runs = [json.loads(check_output([executable, '-c', _STARTUP_SCRIPT, module], env=_env)) for _ in range(repeat)]
+    startup = {'module': module}
+    for _metric in ('import_ms', 'rss_mb'):
+        _values = array([_run[_metric] for _run in _runs])
+        startup[_metric] = {'p{0}'.format(_p): float(percentile(_values, _p)) for _p in PERCENTILES}
+        startup[_metric]['mean'] = float(_values.mean())
+    startup['loaded'] = sorted(set(exclude).intersection(*(_run['modules'] for _run in _runs)))
+    logger.info('import %s p50: %.1f ms, %.1f MB RSS', module, startup['import_ms']['p50'], startup['rss_mb']['p50'])
+    for _package in startup['loaded']:
+        logger.error('import %s loaded %s', module, _package)
+    return startup
+
+
+def compare_startup(current: dict, baseline: dict, threshold=REGRESSION_THRESH, metric='p50') -> list:
+    '''
+    Finds startup metrics worse than baseline by more than threshold
+    :param current: time_startup() output
+    :param baseline: time_startup() output
+    :param threshold: float allowed relative increase
+    :param metric: str summary statistic compared
+    :return: <list> of (metric, baseline, current)
+    '''
+    regressions = []
+    for _metric, _min in STARTUP_MIN.items():
+        _base, _current = baseline[_metric][metric], current[_metric][metric]
+        if _current - _base > _base * threshold and _current - _base > _min:
+            regressions.append((_metric, _base, _current))
+    return regressions
+
+
+def compare_results(current: dict, baseline: dict, threshold=REGRESSION_THRESH, metric='p50') -> list:
+    '''
+    Finds stages slower than baseline by more than threshold
+    :param current: run_benchmark() output
+    :param baseline: run_benchmark() output
+    :param threshold: float allowed relative slowdown
+    :param metric: str summary statistic compared
+    :return: <list> of (input, stage, baseline ms, current ms)
+    '''
+    regressions = []
+    for _name, _stages in current['results'].items():
+        if _name not in baseline['results']:
+            logger.warning('%s not in baseline', _name)
+            continue
+        for _stage, _summary in _stages.items():
+            _base = baseline['results'][_name].get(_stage)
+            if _base is None:
+                continue
+            _delta = _summary[metric] - _base[metric]
+            if _delta > _base[metric] * threshold and _delta > REGRESSION_MIN_MS:
+                regressions.append((_name, _stage, _base[metric], _summary[metric]))
+    return regressions
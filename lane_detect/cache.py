@@ -0,0 +1,272 @@
+import hashlib
+from collections import OrderedDict
+from os import listdir, makedirs, remove, replace, utime, getpid
+from os.path import join, getsize, getmtime
+from sys import getsizeof
+from threading import Lock, get_ident
+from numpy import ndarray, savez, load
+from lane_detect.log import logger
+
+
+CACHE_BYTES = 256 * 2**20
+# result cache
+HASH_NAME     = 'sha1'  # hardware accelerated on most CPUs, ~1 GB/s
+RESULT_FIELDS = ('left_lane', 'right_lane', 'lines', 'roi_filter_lines', 'slope_filter_lines', 'overlay')
+RESULT_EXT    = '.npz'
+
+
+def sizeof(value) -> int:
+    '''
+    Approximate memory held by a cached value
+    :param value: ndarray, or tuple/list/dict of them
+    :return: int bytes
+    '''
+    if isinstance(value, ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(sizeof(_v) for _v in value)
+    if isinstance(value, dict):
+        return sum(sizeof(_v) for _v in value.values())
+    return getsizeof(value)
+
+
+class LRUCache(object):
+    def __init__(self, max_bytes=CACHE_BYTES):
+        '''
+        LRUCache is a thread safe least recently used cache bounded by memory, not entries.
+        Values larger than max_bytes are not cached.
+        :param max_bytes: int memory budget
+        '''
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        '''
+        Retrieves a value, marking it most recently used
+        :param key: hashable key
+        :param default: returned on a miss
+        :return: cached value or default
+        '''
+        with self._lock:
+            _entry = self._entries.get(key)
+            if _entry is None:
+                self.misses = self.misses + 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits = self.hits + 1
+            return _entry[0]
+
+    def put(self, key, value, nbytes=None):
+        '''
+        Caches a value, evicting least recently used values past max_bytes
+        :param key: hashable key
+        :param value: value to cache
+        :param nbytes: int size of value, estimated by sizeof() when None
+        :return: bool True if cached
+        '''
+        if nbytes is None:
+            nbytes = sizeof(value)
+        if nbytes > self.max_bytes:
+            return False
+        with self._lock:
+            _old = self._entries.pop(key, None)
+            if _old is not None:
+                self.nbytes = self.nbytes - _old[1]
+            while self._entries and self.nbytes + nbytes > self.max_bytes:
+                _, (_, _size) = self._entries.popitem(last=False)
+                self.nbytes = self.nbytes - _size
+                self.evictions = self.evictions + 1
+            self._entries[key] = (value, nbytes)
+            self.nbytes = self.nbytes + nbytes
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        '''
+        :return: <dict> {entries, bytes, hits, misses, hit_rate, evictions}
+        '''
+        _lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / _lookups if _lookups else 0.0,
+            'evictions': self.evictions
+        }
+
+
+class ResultCache(object):
+    def __init__(self, max_bytes=CACHE_BYTES, path=None, max_disk_bytes=None, overlay=True, hash_name=HASH_NAME):
+        '''
+        ResultCache maps a hash of frame bytes and pipeline parameters to lane results,
+        so repeated frames skip detection. Entries live in a memory bounded LRUCache,
+        and optionally in a directory shared across runs and processes. Disk entries hold lanes
+        and segments, a few KB, and their overlays are refilled on a hit.
+        Lanes are composited onto the current frame, the frame itself is never cached.
+        :param max_bytes: int memory budget
+        :param path: str directory of the disk tier, disabled when None
+        :param max_disk_bytes: int disk budget, unbounded when None
+        :param overlay: bool cache finished overlays, otherwise lanes are refilled and masked on a hit
+        :param hash_name: str hashlib algorithm
+        '''
+        self.memory = LRUCache(max_bytes)
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self.overlay = overlay
+        self.hash_name = hash_name
+        self.disk_hits = 0
+        self.disk_evictions = 0
+        self.disk_bytes = 0
+        self._disk = OrderedDict()
+        self._lock = Lock()
+        if path is not None:
+            makedirs(path, exist_ok=True)
+            # least recently used first
+            _files = [_f for _f in listdir(path) if _f.endswith(RESULT_EXT) and '.tmp' not in _f]
+            for _f in sorted(_files, key=lambda _f: getmtime(join(path, _f))):
+                self._disk[_f[:-len(RESULT_EXT)]] = getsize(join(path, _f))
+            self.disk_bytes = sum(self._disk.values())
+            with self._lock:
+                self._evict_disk()
+
+    def key(self, frame: ndarray, params: tuple) -> str:
+        '''
+        :param frame: <numpy.ndarray> input frame
+        :param params: tuple pipeline parameters the results depend on
+        :return: str hex digest
+        '''
+        _hash = hashlib.new(self.hash_name, repr((frame.shape, frame.dtype.str) + params).encode())
+        if not frame.flags.c_contiguous:
+            frame = frame.copy()
+        _hash.update(frame)
+        return _hash.hexdigest()
+
+    def get(self, key: str) -> dict:
+        '''
+        :param key: str from key()
+        :return: <dict> {RESULT_FIELDS}, None on a miss
+        '''
+        entry = self.memory.get(key)
+        if entry is None and key in self._disk:
+            entry = self._load(key)
+            if entry is not None:
+                self.memory.put(key, entry)
+        return entry
+
+    def put(self, key: str, entry: dict):
+        self.memory.put(key, entry)
+        if self.path is not None and key not in self._disk:
+            self._save(key, entry)
+
+    def _load(self, key: str) -> dict:
+        _file = join(self.path, key + RESULT_EXT)
+        try:
+            with load(_file) as _data:
+                entry = {_field: _data[_field] if _field in _data.files else None for _field in RESULT_FIELDS}
+            utime(_file)
+        except (OSError, ValueError) as err:
+            logger.error('could not load cached result %s: %s', _file, err)
+            with self._lock:
+                self.disk_bytes = self.disk_bytes - self._disk.pop(key, 0)
+            return None
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            self.disk_hits = self.disk_hits + 1
+        return entry
+
+    def _save(self, key: str, entry: dict):
+        _file = join(self.path, key + RESULT_EXT)
+        _tmp = join(self.path, '{0}.tmp{1}-{2}{3}'.format(key, getpid(), get_ident(), RESULT_EXT))
+        try:
+            savez(_tmp, **{_field: _value for _field, _value in entry.items()
+                           if _value is not None and _field != 'overlay'})
+            replace(_tmp, _file)
+            _size = getsize(_file)
+        except OSError as err:
+            logger.error('could not cache result %s: %s', _file, err)
+            return
+        with self._lock:
+            self._disk[key] = _size
+            self.disk_bytes = self.disk_bytes + _size
+            self._evict_disk()
+
+    def _evict_disk(self):
+        '''
+        Removes least recently used files past max_disk_bytes, called with the lock held
+        '''
+        while self.max_disk_bytes is not None and self.disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+            _key, _size = self._disk.popitem(last=False)
+            self.disk_bytes = self.disk_bytes - _size
+            self.disk_evictions = self.disk_evictions + 1
+            try:
+                remove(join(self.path, _key + RESULT_EXT))
+            except OSError:
+                pass
+
+    def capture(self, filter) -> dict:
+        '''
+        :param filter: <LaneFilter> after apply_roi_mask
+        :return: <dict> {RESULT_FIELDS} entry of the filter's results
+        '''
+        return {
+            'left_lane': filter.left_lane,
+            'right_lane': filter.right_lane,
+            'lines': filter.lines,
+            'roi_filter_lines': filter.roi_filter_lines,
+            'slope_filter_lines': filter.slope_filter_lines,
+            'overlay': filter.image_tf.copy() if self.overlay else None
+        }
+
+    def restore(self, filter, entry: dict):
+        '''
+        Sets cached results on a filter loaded with the frame, leaving it as after apply_roi_mask
+        :param filter: <LaneFilter>
+        :param entry: <dict> from get()
+        '''
+        filter.lines = entry['lines']
+        filter.roi_filter_lines = entry['roi_filter_lines']
+        filter.slope_filter_lines = entry['slope_filter_lines']
+        filter.set_lanes(entry['left_lane'], entry['right_lane'], overlay=entry['overlay'])
+        if entry['overlay'] is None:
+            filter.apply_roi_mask()
+
+    def stats(self) -> dict:
+        '''
+        :return: <dict> {entries, bytes, hits, misses, hit_rate, evictions, disk_entries, disk_bytes,
+                 disk_hits, disk_evictions}, hits include disk hits
+        '''
+        stats = self.memory.stats()
+        stats['hits'] = stats['hits'] + self.disk_hits
+        stats['misses'] = stats['misses'] - self.disk_hits
+        _lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / _lookups if _lookups else 0.0
+        stats['disk_entries'] = len(self._disk)
+        stats['disk_bytes'] = self.disk_bytes
+        stats['disk_hits'] = self.disk_hits
+        stats['disk_evictions'] = self.disk_evictions
+        return stats
+
+    def log_stats(self):
+        _stats = self.stats()
+        logger.info('result cache: %d hits, %d misses, %.0f%% hit rate, %d entries in %.1f MB%s',
+                    _stats['hits'], _stats['misses'], _stats['hit_rate'] * 100, _stats['entries'],
+                    _stats['bytes'] / 2**20, '' if self.path is None else
+                    ', disk: {0} hits, {1} entries in {2:.1f} MB'.format(
+                        _stats['disk_hits'], _stats['disk_entries'], _stats['disk_bytes'] / 2**20))
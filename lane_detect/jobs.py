@@ -0,0 +1,316 @@
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from os import listdir, makedirs, replace
+from os.path import isdir, isfile, join, basename, dirname, splitext, getmtime, getsize
+from shutil import rmtree, which
+from subprocess import run, DEVNULL, PIPE
+from time import perf_counter
+from cv2 import VideoCapture, VideoWriter, VideoWriter_fourcc, cvtColor, \
+    COLOR_BGR2RGB, COLOR_RGB2BGR, CAP_PROP_FPS, CAP_PROP_FRAME_WIDTH, CAP_PROP_FRAME_HEIGHT
+from lane_detect.pipeline import LanePipeline
+from lane_detect.stream import DEFAULT_FPS, FOURCC, FFMPEG_BIN
+from lane_detect.log import logger
+
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.m4v')
+CHUNK_FRAMES     = 300  # frames per output segment, an interrupted job resumes from the last whole segment
+PARTS_SUFFIX     = '.parts'
+CHECKPOINT_FILE  = 'checkpoint.json'
+SEGMENT_NAME     = 'segment_{0:05d}{1}'
+
+# per process pipeline and the pipeline_kwargs it was built from, see _get_pipeline()
+_pipeline     = None
+_pipeline_key = None
+
+
+def read_manifest(filename: str) -> list:
+    '''
+    Reads a job manifest: a JSON list of inputs or {input, output} objects,
+    or a text file of one input per line, optionally followed by a tab and its output
+    :param filename: str manifest path
+    :return: <list> of (input: str, output: str or None)
+    '''
+    with open(filename) as _f:
+        _text = _f.read()
+    if filename.endswith('.json'):
+        return [(_job, None) if isinstance(_job, str) else (_job['input'], _job.get('output'))
+                for _job in json.loads(_text)]
+    jobs = []
+    for _line in _text.splitlines():
+        _line = _line.strip()
+        if not _line or _line.startswith('#'):
+            continue
+        _input, _, _output = _line.partition('\t')
+        jobs.append((_input.strip(), _output.strip() or None))
+    return jobs
+
+
+def expand_jobs(paths: list, output_dir: str) -> list:
+    '''
+    Expands directories of videos, video files and manifests into jobs
+    :param paths: list of str directories, videos or manifests
+    :param output_dir: str output directory of jobs without an explicit output
+    :return: <list> of (input: str, output: str) unique by output
+    '''
+    _jobs = []
+    for _path in paths:
+        if isdir(_path):
+            _jobs.extend((join(_path, _f), None) for _f in sorted(listdir(_path))
+                         if _f.lower().endswith(VIDEO_EXTENSIONS))
+        elif _path.lower().endswith(VIDEO_EXTENSIONS):
+            _jobs.append((_path, None))
+        elif isfile(_path):
+            _jobs.extend(read_manifest(_path))
+        else:
+            logger.warning('%s is not a video, directory or manifest', _path)
+    jobs = {}
+    for _input, _output in _jobs:
+        _output = _output or join(output_dir, basename(_input))
+        if _output in jobs:
+            logger.warning('%s and %s write the same output %s, skipping the latter', jobs[_output], _input, _output)
+            continue
+        jobs[_output] = _input
+    return [(_input, _output) for _output, _input in jobs.items()]
+
+
+def is_up_to_date(source: str, output: str) -> bool:
+    '''
+    :return: bool output exists, is complete and newer than source
+    '''
+    return isfile(output) and not isdir(output + PARTS_SUFFIX) and getmtime(output) >= getmtime(source)
+
+
+def _write_json(filename: str, data: dict):
+    '''
+    Writes through a temporary file, so an interruption leaves the previous version
+    '''
+    with open(filename + '.tmp', 'w') as _f:
+        json.dump(data, _f, indent=2)
+    replace(filename + '.tmp', filename)
+
+
+def load_checkpoint(source: str, output: str, chunk: int, pipeline_kwargs: dict) -> dict:
+    '''
+    Loads the checkpoint of an interrupted job, starting over when the source,
+    segment length or pipeline parameters changed since
+    :return: <dict> {source, size, mtime, chunk, params, segments, frames}
+    '''
+    parts = output + PARTS_SUFFIX
+    fresh = {
+        'source': source,
+        'size': getsize(source),
+        'mtime': getmtime(source),
+        'chunk': chunk,
+        'params': json.loads(json.dumps(pipeline_kwargs)),
+        'segments': 0,
+        'frames': 0
+    }
+    _file = join(parts, CHECKPOINT_FILE)
+    if isfile(_file):
+        try:
+            with open(_file) as _f:
+                checkpoint = json.load(_f)
+            if all(checkpoint.get(_k) == fresh[_k] for _k in ('source', 'size', 'mtime', 'chunk', 'params')):
+                return checkpoint
+            logger.info('%s changed since its checkpoint, starting over', source)
+        except (ValueError, OSError) as err:
+            logger.error('unreadable checkpoint %s: %s', _file, err)
+    if isdir(parts):
+        rmtree(parts)
+    makedirs(parts)
+    return fresh
+
+
+def concat_segments(segments: list, output: str, fps: float, size: tuple):
+    '''
+    Joins segments into output, without re-encoding when ffmpeg is available
+    :param segments: list of str segment files, in order
+    :param output: str output video
+    :param fps: float frame rate
+    :param size: tuple (width, height)
+    '''
+    _tmp = '{0}.tmp{1}'.format(*splitext(output))
+    if which(FFMPEG_BIN):
+        _list = join(dirname(segments[0]), 'segments.txt')
+        with open(_list, 'w') as _f:
+            _f.writelines("file '{0}'\n".format(basename(_s)) for _s in segments)
+        _ret = run([FFMPEG_BIN, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                    '-i', _list, '-c', 'copy', _tmp], stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE)
+        if _ret.returncode:
+            raise RuntimeError('ffmpeg could not join {0}: {1}'.format(output, _ret.stderr.decode().strip()))
+    else:
+        writer = VideoWriter(_tmp, VideoWriter_fourcc(*FOURCC), fps, size)
+        assert writer.isOpened(), 'could not open {0} for writing'.format(_tmp)
+        try:
+            for _segment in segments:
+                capture = VideoCapture(_segment)
+                ok, frame = capture.read()
+                while ok:
+                    writer.write(frame)
+                    ok, frame = capture.read()
+                capture.release()
+        finally:
+            writer.release()
+    replace(_tmp, output)
+
+
+def _get_pipeline(pipeline_kwargs: dict) -> LanePipeline:
+    '''
+    Per process pipeline, rebuilt when pipeline_kwargs differ from the ones it was built from
+    :param pipeline_kwargs: dict LanePipeline parameters
+    :return: <LanePipeline>
+    '''
+    global _pipeline, _pipeline_key
+    _key = json.dumps(pipeline_kwargs, sort_keys=True)
+    if _pipeline is None or _pipeline_key != _key:
+        _pipeline = LanePipeline(**pipeline_kwargs)
+        _pipeline_key = _key
+    return _pipeline
+
+
+def process_video(source: str, output: str, chunk=CHUNK_FRAMES, pipeline_kwargs=None) -> dict:
+    '''
+    Detects lanes in a video, writing output in segments of chunk frames.
+    After each segment a checkpoint is saved, so an interrupted job resumes at the
+    last whole segment. Segments are joined into output once the source is done.
+    :param source: str input video
+    :param output: str output video
+    :param chunk: int frames per segment
+    :param pipeline_kwargs: dict LanePipeline parameters
+    :return: <dict> {input, output, frames, resumed, seconds}
+    '''
+    _t = perf_counter()
+    pipeline_kwargs = pipeline_kwargs or {}
+    parts = output + PARTS_SUFFIX
+    checkpoint = load_checkpoint(source, output, chunk, pipeline_kwargs)
+    resumed = checkpoint['frames']
+    capture = VideoCapture(source)
+    if not capture.isOpened():
+        raise RuntimeError('{0} could not be opened.'.format(source))
+    fps = capture.get(CAP_PROP_FPS) or DEFAULT_FPS
+    size = (int(capture.get(CAP_PROP_FRAME_WIDTH)), int(capture.get(CAP_PROP_FRAME_HEIGHT)))
+    _ext = splitext(output)[1]
+    try:
+        if resumed:
+            logger.info('resuming %s at frame %d', source, resumed)
+        for _ in range(resumed):
+            if not capture.grab():
+                raise RuntimeError('{0} is shorter than its checkpoint'.format(source))
+        pipeline = _get_pipeline(pipeline_kwargs)
+        # workers reuse one pipeline, nothing of the previous video may carry over:
+        # tracking restarts, and only the session of this video's frame shape is kept
+        pipeline.trackers.clear()
+        _shape = (size[1], size[0], 3)
+        for _session in [_s for _s in pipeline.sessions if _s != _shape]:
+            del pipeline.sessions[_session]
+        ok, frame = capture.read()
+        while ok:
+            _segment = join(parts, SEGMENT_NAME.format(checkpoint['segments'], _ext))
+            _tmp = '{0}.tmp{1}'.format(*splitext(_segment))
+            writer = VideoWriter(_tmp, VideoWriter_fourcc(*FOURCC), fps, size)
+            assert writer.isOpened(), 'could not open {0} for writing'.format(_tmp)
+            _frames = 0
+            try:
+                while ok and _frames < chunk:
+                    lane = pipeline.process(cvtColor(frame, COLOR_BGR2RGB, dst=frame))
+                    writer.write(cvtColor(lane, COLOR_RGB2BGR, dst=frame))
+                    _frames = _frames + 1
+                    ok, frame = capture.read()
+            finally:
+                writer.release()
+            replace(_tmp, _segment)
+            checkpoint['segments'] = checkpoint['segments'] + 1
+            checkpoint['frames'] = checkpoint['frames'] + _frames
+            _write_json(join(parts, CHECKPOINT_FILE), checkpoint)
+    finally:
+        capture.release()
+    if not checkpoint['segments']:
+        raise RuntimeError('{0} has no frames'.format(source))
+    concat_segments([join(parts, SEGMENT_NAME.format(_i, _ext)) for _i in range(checkpoint['segments'])],
+                    output, fps, size)
+    rmtree(parts)
+    return {
+        'input': source,
+        'output': output,
+        'frames': checkpoint['frames'],
+        'resumed': resumed,
+        'seconds': perf_counter() - _t
+    }
+
+
+class VideoJobRunner(object):
+    def __init__(self, jobs=1, output_dir='test_videos_output', chunk=CHUNK_FRAMES, force=False, **pipeline_kwargs):
+        '''
+        VideoJobRunner processes many videos on one shared worker pool, largest first.
+        Outputs newer than their inputs are skipped, and interrupted outputs resume
+        from their last checkpointed segment, see process_video().
+        :param jobs: int worker processes, videos are processed in this process when 1
+        :param output_dir: str output directory of inputs without an explicit output
+        :param chunk: int frames per segment
+        :param force: bool reprocess up to date outputs
+        :param pipeline_kwargs: LanePipeline parameters
+        '''
+        self.jobs = jobs
+        self.output_dir = output_dir
+        self.chunk = chunk
+        self.force = force
+        self.pipeline_kwargs = pipeline_kwargs
+
+    def _run_inline(self, jobs: list):
+        for _input, _output in jobs:
+            try:
+                yield process_video(_input, _output, self.chunk, self.pipeline_kwargs)
+            except Exception as err:
+                yield {'input': _input, 'output': _output, 'error': str(err)}
+
+    def _run_processes(self, jobs: list):
+        with ProcessPoolExecutor(max_workers=self.jobs, mp_context=get_context('spawn')) as executor:
+            _futures = {executor.submit(process_video, _input, _output, self.chunk, self.pipeline_kwargs):
+                        (_input, _output) for _input, _output in jobs}
+            for _future in as_completed(_futures):
+                try:
+                    yield _future.result()
+                except Exception as err:
+                    _input, _output = _futures[_future]
+                    yield {'input': _input, 'output': _output, 'error': str(err)}
+
+    def run(self, paths: list):
+        '''
+        Processes all videos, yielding per video results as they complete
+        :param paths: list of str directories, videos or manifests, see expand_jobs()
+        :return: generator of <dict> {input, output, frames, resumed, seconds, skipped or error}
+        '''
+        jobs = []
+        skipped = 0
+        missing = 0
+        for _input, _output in expand_jobs(paths, self.output_dir):
+            if not isfile(_input):
+                logger.error('%s not found', _input)
+                missing = missing + 1
+                yield {'input': _input, 'output': _output, 'error': 'not found'}
+            elif not self.force and is_up_to_date(_input, _output):
+                skipped = skipped + 1
+                yield {'input': _input, 'output': _output, 'skipped': True}
+            else:
+                makedirs(dirname(_output) or '.', exist_ok=True)
+                jobs.append((_input, _output))
+        # long videos first, so they do not start last and leave the pool idle
+        jobs.sort(key=lambda _job: getsize(_job[0]), reverse=True)
+        logger.info('processing %d videos with %d %s, %d up to date', len(jobs), self.jobs,
+                    'processes' if self.jobs > 1 else 'process', skipped)
+        _t = perf_counter(); _frames = 0; _done = 0; _failed = missing
+        _run = self._run_processes if self.jobs > 1 else self._run_inline
+        for _result in _run(jobs):
+            if 'error' in _result:
+                _failed = _failed + 1
+                logger.error('%s failed: %s', _result['input'], _result['error'])
+            else:
+                _done = _done + 1
+                _frames = _frames + _result['frames'] - _result['resumed']
+                logger.info('%s: %d frames in %.1f s%s', _result['output'], _result['frames'], _result['seconds'],
+                            ', resumed at frame {0}'.format(_result['resumed']) if _result['resumed'] else '')
+            yield _result
+        _elapsed = perf_counter() - _t
+        logger.info('%d videos done, %d failed, %d up to date: %d frames in %.1f s, %.1f frames/sec',
+                    _done, _failed, skipped, _frames, _elapsed, _frames / _elapsed if _elapsed else 0.0)
@@ -0,0 +1,109 @@
+from numpy import ndarray, array, empty, zeros, concatenate, bincount, absolute, maximum, minimum, isfinite, \
+    errstate, int32, intp, float64
+from lane_detect.log import logger
+
+
+# drawing thresholds
+LOWER_X_OFFSET   = 5
+UPPER_X_OFFSET   = 10
+# fitting
+FIT_METHODS      = ('weighted', 'huber')
+HUBER_DELTA      = 10.0  # pixels, end points further from the fit are down-weighted
+HUBER_ITERATIONS = 3
+SIDES            = 2     # 0: left lane (negative slope), 1: right lane (positive slope)
+
+
+def weighted_fit(side: ndarray, x: ndarray, y: ndarray, weights: ndarray, sides=SIDES) -> (ndarray, ndarray):
+    '''
+    Weighted least squares fit of x = a * y + b for every side at once.
+    x is fit against y, so steep lane lines stay well conditioned.
+    :param side: <numpy.ndarray> int side of each point
+    :param x: <numpy.ndarray> float x values
+    :param y: <numpy.ndarray> float y values
+    :param weights: <numpy.ndarray> float point weights
+    :param sides: int number of sides, e.g. SIDES per frame of a batch
+    :return: <tuple> (a: ndarray, b: ndarray) per side, nan for a side without a fit
+    '''
+    sw  = bincount(side, weights, minlength=sides)
+    sx  = bincount(side, weights * x, minlength=sides)
+    sy  = bincount(side, weights * y, minlength=sides)
+    syy = bincount(side, weights * y * y, minlength=sides)
+    sxy = bincount(side, weights * x * y, minlength=sides)
+    with errstate(divide='ignore', invalid='ignore'):
+        a = (sw * sxy - sx * sy) / (sw * syy - sy * sy)
+        b = (sx - a * sy) / sw
+    return a, b
+
+
+def fit_lanes(signals: ndarray, lower_bound: int, upper_bound: int, method=FIT_METHODS[0],
+              lower_x_offset=LOWER_X_OFFSET, upper_x_offset=UPPER_X_OFFSET) -> (ndarray, ndarray):
+    '''
+    Fits one lane line per side through the end points of the filtered segments, weighted
+    by segment magnitude, and converts both lines into lane polygons in one vectorized pass
+    :param signals: <numpy.ndarray> SIGNAL_DTYPE records, e.g. from interpolate_dominate_lines
+    :param lower_bound: int top y value of the lanes
+    :param upper_bound: int bottom y value of the lanes
+    :param method: str 'weighted' least squares, or 'huber' iteratively reweighted, robust to outliers
+    :return: <tuple> (left_lane, right_lane) int32 polygons of 4 (x, y) vertices, None for no lane
+    '''
+    polygons, found = fit_lane_polygons(signals, zeros(len(signals), dtype=intp), 1, lower_bound, upper_bound,
+                                        method, lower_x_offset, upper_x_offset)
+    left_lane, right_lane = [polygons[0, _side] if found[0, _side] else None for _side in range(SIDES)]
+    logger.debug('polygons (left-lane, right-lane):\n(%s,\n%s)', left_lane, right_lane)
+    return left_lane, right_lane
+
+
+def fit_lanes_batch(signals: ndarray, frames: int, lower_bound: int, upper_bound: int, method=FIT_METHODS[0],
+                    lower_x_offset=LOWER_X_OFFSET, upper_x_offset=UPPER_X_OFFSET) -> list:
+    '''
+    fit_lanes() over a batch of frames, the lines of all frames and sides are fit in one pass
+    :param signals: <numpy.ndarray> BATCH_SIGNAL_DTYPE records, e.g. from interpolate_dominate_lines_batch
+    :param frames: int number of frames in the batch
+    :param lower_bound: int top y value of the lanes
+    :param upper_bound: int bottom y value of the lanes
+    :param method: str 'weighted' least squares, or 'huber' iteratively reweighted, robust to outliers
+    :return: <list> (left_lane, right_lane) per frame, as fit_lanes()
+    '''
+    polygons, found = fit_lane_polygons(signals, signals['frame'], frames, lower_bound, upper_bound,
+                                        method, lower_x_offset, upper_x_offset)
+    return [tuple(polygons[_frame, _side] if found[_frame, _side] else None for _side in range(SIDES))
+            for _frame in range(frames)]
+
+
+def fit_lane_polygons(signals: ndarray, frame: ndarray, frames: int, lower_bound: int, upper_bound: int,
+                      method=FIT_METHODS[0], lower_x_offset=LOWER_X_OFFSET,
+                      upper_x_offset=UPPER_X_OFFSET) -> (ndarray, ndarray):
+    '''
+    Fits one lane line per frame and side, see fit_lanes()
+    :param signals: <numpy.ndarray> SIGNAL_DTYPE or BATCH_SIGNAL_DTYPE records
+    :param frame: <numpy.ndarray> int frame of each signal
+    :param frames: int number of frames
+    :return: <tuple> (polygons: (frames, SIDES, 4, 2) int32 ndarray, found: (frames, SIDES) bool ndarray)
+    '''
+    assert method in FIT_METHODS, 'fit method must be one of {0}'.format(FIT_METHODS)
+    _side = frame * SIDES + (signals['slope'] > 0)
+    # both end points of a segment, each carrying half of its magnitude
+    side = concatenate((_side, _side))
+    x = concatenate((signals['x1'], signals['x2'])).astype(float64)
+    y = concatenate((signals['y1'], signals['y2'])).astype(float64)
+    weights = concatenate((signals['magnitude'], signals['magnitude'])) / 2
+    a, b = weighted_fit(side, x, y, weights, sides=frames * SIDES)
+    if method == 'huber' and len(x):
+        for _ in range(HUBER_ITERATIONS):
+            _residual = absolute(x - (a[side] * y + b[side]))
+            _huber = minimum(1.0, HUBER_DELTA / maximum(_residual, HUBER_DELTA * 1e-6))
+            a, b = weighted_fit(side, x, y, weights * _huber, sides=frames * SIDES)
+    x_lower = a * lower_bound + b
+    x_upper = a * upper_bound + b
+    found = isfinite(x_lower) & isfinite(x_upper)
+    # (frame * side, vertex, xy)
+    polygons = empty((frames * SIDES, 4, 2), dtype=int32)
+    polygons[:, :, 1] = (lower_bound, upper_bound, upper_bound, lower_bound)
+    if found.any():
+        polygons[found, :, 0] = array([
+            x_lower - lower_x_offset,
+            x_upper - upper_x_offset,
+            x_upper + upper_x_offset,
+            x_lower + lower_x_offset
+        ]).T[found].round()
+    return polygons.reshape(frames, SIDES, 4, 2), found.reshape(frames, SIDES)
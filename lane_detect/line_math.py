@@ -1,5 +1,8 @@
-from numpy import square, sqrt, array, ndarray
-from lane_detect.log import logger
+from numpy import square, sqrt, ndarray, dtype, empty, zeros, array, asarray, absolute, lexsort, minimum, full, \
+    count_nonzero, flatnonzero, trunc, concatenate, repeat, diff, split, searchsorted, arange, isfinite, \
+    int32, int64, intp, float64, inf
+from lane_detect.log import logger, diagnostics
+from lane_detect.stats import count
 
 
 # filter thresholds
@@ -7,141 +10,229 @@ SLOPE_THRESHOLD  = 0.08
 SLOPE_MAX_CUTOFF = 0.9
 SLOPE_VARIANCE   = 0.25
 MAGNITUDE_THRESH = 100
-# drawing thresholds
-LOWER_X_OFFSET   = 5
-UPPER_X_OFFSET   = 10
+# compact per-segment record produced by find_dominate_signals
+SIGNAL_DTYPE = dtype([
+    ('x1', int32), ('y1', int32), ('x2', int32), ('y2', int32),
+    ('slope', float64), ('offset', float64), ('magnitude', float64)
+])
+# the same record tagged with the frame of a batch, see find_dominate_signals_batch
+BATCH_SIGNAL_DTYPE = dtype(SIGNAL_DTYPE.descr + [('frame', intp)])
 
 
-def sort_slopes(lines: dict, slope_thresh=SLOPE_THRESHOLD) -> list:
+def sort_slopes(signals: ndarray, slope_thresh=SLOPE_THRESHOLD) -> list:
     '''
     Sorts slopes into negative and positive sets
-    :param lines: dict lines
-    :return: <list> [negative, positive]
+    :param signals: <numpy.ndarray> SIGNAL_DTYPE records
+    :return: <list> [negative: ndarray, positive: ndarray]
     '''
-    neg_slopes = []; pos_slopes = []
-    try:
-        for _line in lines:
-            _slope = lines[_line]['slope']
-            abs_slope = abs(_slope)
-            if  abs_slope > slope_thresh:
-                if _slope < 0: # likely right-side
-                    neg_slopes.append(_slope)
-                else: # likely left-side
-                    pos_slopes.append(_slope)
-            else:
-                logger.warning('throwing out %s, mag: %s', lines[_line]['slope'], lines[_line]['magnitude'])
-    except Exception as err:
-        logger.error('bad sort: %s', err)
-    return [neg_slopes, pos_slopes]
+    _slopes = signals['slope']
+    _keep = absolute(_slopes) > slope_thresh
+    if diagnostics.enabled and not _keep.all():
+        diagnostics.record('slope_below_thresh', count_nonzero(~_keep), _slopes[~_keep])
+    _slopes = _slopes[_keep]
+    return [_slopes[_slopes < 0], _slopes[_slopes >= 0]]
 
 
 def get_slope_stats(slopes: list, threshold=SLOPE_THRESHOLD) -> dict:
     '''
     Gives statistics on slope variances
-    :param slopes: list of all slopes
-    :return: <list> [lane_label, min, max, mean, std]
+    :param slopes: list of slope arrays, from sort_slopes
+    :return: <dict> {lane_label: {min, max, mean, std}}
     '''
     _ret = {}
     try:
         for _slopes in slopes:
-            _min = -threshold; _max = threshold
-            _lane = '?'; _stdev = []
-            if _slopes:
-                for _slope in _slopes:
-                    if not _slope:
-                        continue
-                    elif _slope < 0:
-                        _lane = 'right'
-                    else:
-                        _lane = 'left'
-                    _min = min(_slope, _min)
-                    _max = max(_slope, _max)
-                assert len(_slopes) != 0, 'no slopes found'
-                _mean = sum(_slopes) / len(_slopes)
-                for _slope in _slopes:
-                    _stdev.append(square(_slope - _mean))
-                _std = sum(_stdev) / len(_slopes)
-                _ret[_lane] = {
-                    'min': _min,
-                    'max': _max,
-                    'mean': _mean,
-                    'std': _std
-                }
-            else:
+            if not _slopes.size:
                 logger.debug('no slopes in input')
+                continue
+            _lane = 'right' if _slopes[-1] < 0 else 'left'
+            _mean = _slopes.mean()
+            _ret[_lane] = {
+                'min': min(_slopes.min(), -threshold),
+                'max': max(_slopes.max(), threshold),
+                'mean': _mean,
+                'std': square(_slopes - _mean).mean()
+            }
     except Exception as err:
         logger.error('bad stats: %s in %s', err, slopes)
     return _ret
 
 
-def valid_within_fov(points: list, region_mask: array) -> bool:
+def get_segments(lines: ndarray) -> ndarray:
+    '''
+    Flattens HoughLinesP output into rows of (x1, y1, x2, y2)
+    :param lines: <numpy.ndarray> (N,1,4) line segments, or None
+    :return: <numpy.ndarray> (N,4) int32
+    '''
+    if lines is None:
+        return empty((0, 4), dtype=int32)
+    return asarray(lines, dtype=int32).reshape(-1, 4)
+
+
+def get_batch_segments(lines: list) -> (ndarray, ndarray):
     '''
-    Validates if point are withing the region mask
-    :param points: list tuple (x: int, y: int)
-    :param region_mask: array([bool])
-    :return: True if valid
+    Concatenates the HoughLinesP output of a batch of frames
+    :param lines: list of <numpy.ndarray> (N,1,4) line segments, or None, per frame
+    :return: <tuple> (segments: (N,4) int32 of all frames, frame: (N,) intp frame of each segment)
     '''
-    for _x, _y in points:
-        if region_mask[_y][_x][0]:
-            return True
-    return False
+    segments = [get_segments(_lines) for _lines in lines]
+    frame = repeat(range(len(segments)), [len(_segments) for _segments in segments]).astype(intp)
+    if not segments:
+        return empty((0, 4), dtype=int32), frame
+    return concatenate(segments), frame
 
 
-def find_dominate_signals(lines: ndarray, signals: dict, region_mask: array,
+def get_frames(signals: ndarray) -> ndarray:
+    '''
+    :param signals: <numpy.ndarray> BATCH_SIGNAL_DTYPE records, or SIGNAL_DTYPE records of one frame
+    :return: <numpy.ndarray> frame of each record
+    '''
+    if 'frame' in signals.dtype.names:
+        return signals['frame']
+    return zeros(len(signals), dtype=intp)
+
+
+def split_batch(signals: ndarray, frames: int) -> list:
+    '''
+    Splits batch records back into frames
+    :param signals: <numpy.ndarray> BATCH_SIGNAL_DTYPE records in frame order
+    :param frames: int number of frames in the batch
+    :return: <list> of <numpy.ndarray> SIGNAL_DTYPE records per frame
+    '''
+    _signals = empty(len(signals), dtype=SIGNAL_DTYPE)
+    for _field in SIGNAL_DTYPE.names:
+        _signals[_field] = signals[_field]
+    return split(_signals, searchsorted(signals['frame'], arange(1, frames)))
+
+
+def valid_within_fov(segments: ndarray, region_mask: ndarray) -> ndarray:
+    '''
+    Validates if either end point of each segment is within the region mask
+    :param segments: <numpy.ndarray> (N,4) rows of (x1, y1, x2, y2)
+    :param region_mask: ROI mask, only the first channel is tested
+    :return: <numpy.ndarray> (N,) bool, True if valid
+    '''
+    if region_mask.ndim > 2:
+        region_mask = region_mask[..., 0]
+    return valid_within_fov_batch(segments, zeros(len(segments), dtype=intp), region_mask[None])
+
+
+def valid_within_fov_batch(segments: ndarray, frame: ndarray, frame_masks: ndarray, region_mask=None) -> ndarray:
+    '''
+    valid_within_fov() over a batch, a shared region mask is applied to the frames at the end points only,
+    instead of masking every pixel of every frame
+    :param segments: <numpy.ndarray> (N,4) rows of (x1, y1, x2, y2)
+    :param frame: <numpy.ndarray> (N,) frame of each segment
+    :param frame_masks: <numpy.ndarray> (frames, H, W) per frame masks, e.g. a channel of the frames
+    :param region_mask: <numpy.ndarray> (H, W) ROI mask shared by all frames, None if frame_masks are masked
+    :return: <numpy.ndarray> (N,) bool, True if valid
+    '''
+    x1, y1, x2, y2 = segments.T
+    _first = frame_masks[frame, y1, x1] != 0
+    _second = frame_masks[frame, y2, x2] != 0
+    if region_mask is not None:
+        _first &= region_mask[y1, x1] != 0
+        _second &= region_mask[y2, x2] != 0
+    return _first | _second
+
+
+def find_dominate_signals(lines: ndarray, region_mask: ndarray,
                           slope_max_cutoff=SLOPE_MAX_CUTOFF, slope_thresh=SLOPE_THRESHOLD,
-                          magnitude_thresh=MAGNITUDE_THRESH) -> float:
+                          magnitude_thresh=MAGNITUDE_THRESH, counters=None) -> (ndarray, float):
     '''
     Filters subset of dominate signals in line segments and returns mean slope
     :param lines: <numpy.ndarray> line segments
-    :param signals dict filtered by one point valid in ROI
     :param region_mask: ROI mask shape
+    :param slope_max_cutoff: filters out near vertical lines
     :param slope_thresh: filters by slope general lane pitch
     :param magnitude_thresh: filters lines by dominant signal length
-    :return: mean_slope: int of dominant signals
+    :param counters: dict segment counters, collected when not None
+    :return: <tuple> (signals: ndarray of SIGNAL_DTYPE filtered by one point valid in ROI,
+                      mean_slope: float of dominant signals)
     '''
-    i = 0; max_slope = 0.0; min_slope = 0.0; max_signal = 0; x_valid = 0
-    try:
-        for _line in lines:
-            for x1, y1, x2, y2 in _line:
-                if x1 == x2 or y1 == y2:
-                    logger.warning('disregarding: %s, %s', (x1, y1), (x2, y2))
-                    continue
-                if not valid_within_fov([(x1, y1), (x2, y2)], region_mask):
-                    logger.debug('invalid in FOV, thowing out %s', (x1,y1,x2,y2))
-                    continue
-                slope = (y2 - y1) / (x2 - x1)
-                assert slope != 0, 'slope is zero {0}'.format(_line)
-                offset = y1 - (x1 * slope)
-                magnitude = sqrt((square(x2 - x1) + square(y2 - y1)))
-                abs_slope = abs(slope)
-                if magnitude > magnitude_thresh and abs_slope > slope_thresh and abs_slope < slope_max_cutoff:
-                        if min_slope == 0:
-                            min_slope = abs_slope
-                        else:
-                            min_slope = min(abs_slope, min_slope)
-                        logger.debug('points: %s\t slope: %6.3f\t magnitude: %6.3f', (x1, y1, x2, y2), slope, magnitude)
-                        if magnitude > max_signal:
-                            max_slope = abs(slope)
-                            max_signal = magnitude
-                signals[i] = {
-                    'slope': slope,
-                    'offset': offset,
-                    'magnitude': magnitude,
-                    'p1': (x1, y1),
-                    'p2': (x2, y2)
-                }
-                i = i + 1
-    except Exception as err:
-        logger.error('bad signal: %s in %s', err, signals)
+    if region_mask.ndim > 2:
+        region_mask = region_mask[..., 0]
+    signals, mean_slope = find_dominate_signals_batch([lines], region_mask[None], slope_max_cutoff=slope_max_cutoff,
+                                                      slope_thresh=slope_thresh, magnitude_thresh=magnitude_thresh,
+                                                      counters=counters, record_dtype=SIGNAL_DTYPE)
+    return signals, float(mean_slope[0])
+
+
+def find_dominate_signals_batch(lines: list, frame_masks: ndarray, region_mask=None,
+                                slope_max_cutoff=SLOPE_MAX_CUTOFF, slope_thresh=SLOPE_THRESHOLD,
+                                magnitude_thresh=MAGNITUDE_THRESH, counters=None,
+                                record_dtype=BATCH_SIGNAL_DTYPE) -> (ndarray, ndarray):
+    '''
+    find_dominate_signals() over a batch of frames in one vectorized pass, the segments of
+    all frames are filtered together and the mean slope is reduced per frame
+    :param lines: list of <numpy.ndarray> line segments per frame
+    :param frame_masks: <numpy.ndarray> (frames, H, W) per frame masks, see valid_within_fov_batch()
+    :param region_mask: <numpy.ndarray> (H, W) ROI mask shared by all frames, or None
+    :param slope_max_cutoff: filters out near vertical lines
+    :param slope_thresh: filters by slope general lane pitch
+    :param magnitude_thresh: filters lines by dominant signal length
+    :param counters: dict segment counters of the whole batch, collected when not None
+    :param record_dtype: BATCH_SIGNAL_DTYPE, or SIGNAL_DTYPE for a single frame
+    :return: <tuple> (signals: ndarray of record_dtype in frame order filtered by one point valid in ROI,
+                      mean_slope: (frames,) float64 ndarray of dominant signals per frame)
+    '''
+    frames = len(lines)
+    segments, frame = get_batch_segments(lines)
+    x1, y1, x2, y2 = segments.T
+    _valid = (x1 != x2) & (y1 != y2)
+    if diagnostics.enabled and not _valid.all():
+        diagnostics.record('axis_aligned', count_nonzero(~_valid), segments[~_valid])
+    _aligned = len(segments) - count_nonzero(_valid)
+    _in_fov = valid_within_fov_batch(segments[_valid], frame[_valid], frame_masks, region_mask)
+    if diagnostics.enabled and not _in_fov.all():
+        diagnostics.record('outside_fov', count_nonzero(~_in_fov), segments[_valid][~_in_fov])
+    _valid[_valid] = _in_fov
+    if counters is not None:
+        count(counters, 'segments_in', len(segments))
+        count(counters, 'segments_axis_aligned', _aligned)
+        count(counters, 'segments_outside_fov', len(segments) - _aligned - count_nonzero(_valid))
+    segments = segments[_valid]
+    frame = frame[_valid]
+
+    signals = empty(len(segments), dtype=record_dtype)
+    for _i, _field in enumerate(('x1', 'y1', 'x2', 'y2')):
+        signals[_field] = segments[:, _i]
+    if 'frame' in record_dtype.names:
+        signals['frame'] = frame
+    dx = signals['x2'] - signals['x1']
+    dy = signals['y2'] - signals['y1']
+    signals['slope'] = dy / dx
+    signals['offset'] = signals['y1'] - signals['x1'] * signals['slope']
+    signals['magnitude'] = sqrt(square(dx, dtype=float64) + square(dy, dtype=float64))
+
+    # dominant signals only steer the mean slope, all valid signals are returned
+    abs_slope = absolute(signals['slope'])
+    _dominant = (signals['magnitude'] > magnitude_thresh) & \
+                (abs_slope > slope_thresh) & (abs_slope < slope_max_cutoff)
+    if counters is not None:
+        count(counters, 'segments_weak', len(signals) - count_nonzero(_dominant))
+    _frame = frame[_dominant]
+    _slopes = abs_slope[_dominant]
+    _magnitudes = signals['magnitude'][_dominant]
+    min_slope = full(frames, inf)
+    minimum.at(min_slope, _frame, _slopes)
+    min_slope[~isfinite(min_slope)] = 0.0
+    # strongest signal per frame, the first one of equal magnitudes as argmax picks
+    max_slope = full(frames, 0.0)
+    max_signal = full(frames, 0.0)
+    _order = lexsort((-_magnitudes, _frame))
+    _strongest = _order[diff(_frame[_order], prepend=-1) != 0]
+    max_slope[_frame[_strongest]] = _slopes[_strongest]
+    max_signal[_frame[_strongest]] = _magnitudes[_strongest]
     mean_slope = (max_slope + min_slope) / 2
     logger.debug('mean_slope: %s, max: %s, min: %s, max_signal: %s', mean_slope, max_slope, min_slope, max_signal)
-    return mean_slope
+    return signals, mean_slope
 
 
-def find_mean_slope(signals: dict, slope_thresh=SLOPE_THRESHOLD) -> float:
+def find_mean_slope(signals: ndarray, slope_thresh=SLOPE_THRESHOLD) -> float:
     '''
     Finds the mean slope from provided line data
-    :param signals: dict line data
+    :param signals: <numpy.ndarray> SIGNAL_DTYPE records
     :param slope_thresh: float default mean, which could be dominant mean..
     :return: float new mean
     '''
@@ -160,125 +251,69 @@ def find_mean_slope(signals: dict, slope_thresh=SLOPE_THRESHOLD) -> float:
     return slope_thresh
 
 
-def interpolate_dominate_lines(signals: dict, interpolations: dict,
-                               mean_slope: float, lower_bound: int, upper_bound: int, horizontal_limit: int,
-                               slope_variance=SLOPE_VARIANCE):
+def find_mean_slope_batch(signals: ndarray, mean_slope: ndarray) -> ndarray:
+    '''
+    find_mean_slope() per frame of a batch
+    :param signals: <numpy.ndarray> BATCH_SIGNAL_DTYPE records in frame order
+    :param mean_slope: <numpy.ndarray> default mean per frame, e.g. from find_dominate_signals_batch
+    :return: <numpy.ndarray> new mean per frame
+    '''
+    _bounds = searchsorted(signals['frame'], arange(len(mean_slope) + 1))
+    return array([find_mean_slope(signals[_bounds[_i]:_bounds[_i + 1]], _mean) for _i, _mean in enumerate(mean_slope)],
+                 dtype=float64)
+
+
+def interpolate_dominate_lines(signals: ndarray, mean_slope: float, lower_bound: int, upper_bound: int,
+                               horizontal_limit: int, slope_variance=SLOPE_VARIANCE, counters=None) -> ndarray:
     '''
-    Interpolates lines based on ROI mask and mean_slope
-    :param signals: dominate signals in image
+    Keeps signals near mean_slope whose lines, extended between the lane bounds, stay in the image
+    :param signals: <numpy.ndarray> dominate signals in image
     :param mean_slope: mean of dominate signals
     :param lower_bound: int lower y value in image
     :param upper_bound: int upper y value in image
     :param horizontal_limit int maximum possible x-value
     :param slope_variance: acceptable slope variance
+    :param counters: dict line counters, collected when not None
+    :return: <numpy.ndarray> kept SIGNAL_DTYPE records
     '''
-    try:
-        for _line in signals:
-            _slope  = signals[_line]['slope']
-            _offset = signals[_line]['offset']
-            x1, y1  = signals[_line]['p1']
-            x2, y2  = signals[_line]['p2']
-            if not _slope:
-                continue
-            abs_slope = abs(_slope)
-            delta = abs(abs_slope - mean_slope)
-            if delta < slope_variance:
-                logger.debug('%s\t %s', (x1, y1), (x2, y2))
-                assert _slope != 0, 'slope is zero in signals'
-                new_p1 = (int((lower_bound - _offset) / _slope), lower_bound)
-                new_p2 = (int((upper_bound - _offset) / _slope), upper_bound)
-                is_valid = True
-                for _x, _y in [new_p1, new_p2]:
-                    if _x < 0:
-                        logger.warning('line extends too far left, throwing out %s', (_x, _y))
-                        is_valid = False
-                    elif _x > horizontal_limit:
-                        logger.warning('line extends too far right, throwing out %s', (_x, _y))
-                        is_valid = False
-                if is_valid:
-                    interpolations[_line] = {
-                        'slope': _slope,
-                        'offset': _offset,
-                        'p1': new_p1,
-                        'p2': new_p2
-                    }
-    except Exception as err:
-        logger.error('interpolation error: %s', err)
+    return interpolate_dominate_lines_batch(signals, array([mean_slope], dtype=float64), lower_bound, upper_bound,
+                                            horizontal_limit, slope_variance=slope_variance, counters=counters)
 
 
-def get_point_stats(edges: dict, lower_bound: int) -> (int, int):
+def interpolate_dominate_lines_batch(signals: ndarray, mean_slope: ndarray, lower_bound: int, upper_bound: int,
+                                     horizontal_limit: int, slope_variance=SLOPE_VARIANCE, counters=None) -> ndarray:
     '''
-    Averages x values and returns mean tuple (x1, x2)
-    :param edges: dict on line info
-    :param lower_bound: lower y value
-    :return: <tuple> (mean_x1: int, mean_x2: int)
-    '''
-    min_x1 = 0; min_x2 = 0
-    max_x1 = 0; max_x2 = 0
-    cnt_x1 = []; cnt_x2 = []
-    for _line in edges:
-        x1, y1 = edges[_line]['p1']
-        x2, y2 = edges[_line]['p2']
-        if lower_bound == y1:
-            min_x1 = min(x1, min_x1)
-            max_x1 = max(x1, max_x1)
-            min_x2 = min(x2, min_x2)
-            max_x2 = max(x2, max_x2)
-            cnt_x1.append(x1)
-            cnt_x2.append(x2)
-        else:
-            min_x2 = min(x1, min_x1)
-            max_x2 = max(x1, max_x1)
-            min_x1 = min(x2, min_x2)
-            max_x1 = max(x2, max_x2)
-            cnt_x2.append(x1)
-            cnt_x1.append(x2)
-    assert len(cnt_x1) != 0, 'len cnt_x1 is zero'
-    assert len(cnt_x2) != 0, 'len cnt_x2 is zero'
-    mean_x1 = int(sum(cnt_x1) / len(cnt_x1))
-    mean_x2 = int(sum(cnt_x2) / len(cnt_x2))
-    return mean_x1, mean_x2
-
-
-def convert_lane_edges_to_polygons(edges: dict, lower_bound: int, upper_bound: int,
-                                   lower_x_offset=LOWER_X_OFFSET, upper_x_offset=UPPER_X_OFFSET) -> (array, array):
-    '''
-    Converts interpolated lines lanes into lane polygons
-    :param edges: dict of line info
-    :param lower_bound: lower y value in image
-    :param upper_bound: upper y value in image
-    :return: <tuple> (left_lane: array, right_lane: array)
+    interpolate_dominate_lines() over a batch of frames, each signal is compared to the mean slope of its frame
+    :param signals: <numpy.ndarray> BATCH_SIGNAL_DTYPE records, or SIGNAL_DTYPE records of one frame
+    :param mean_slope: <numpy.ndarray> mean of dominate signals per frame
+    :param lower_bound: int lower y value in image
+    :param upper_bound: int upper y value in image
+    :param horizontal_limit int maximum possible x-value
+    :param slope_variance: acceptable slope variance
+    :param counters: dict line counters of the whole batch, collected when not None
+    :return: <numpy.ndarray> kept records
     '''
-    left = {}; right = {}
-
-    for _line in edges:
-        _slope = edges[_line]['slope']
-        if _slope < 0:
-            right[_line] = edges[_line]
-        else:
-            left[_line] = edges[_line]
-
-    if left:
-        mean_left_lower, mean_left_upper = get_point_stats(left, lower_bound)
-        poly_left = array([
-            ((mean_left_lower - lower_x_offset), lower_bound),
-            ((mean_left_upper - upper_x_offset), upper_bound),
-            ((mean_left_upper + upper_x_offset), upper_bound),
-            ((mean_left_lower + lower_x_offset), lower_bound)
-        ])
-    else:
-        poly_left = array(None)
-
-    if right:
-        mean_right_lower, mean_right_upper = get_point_stats(right, lower_bound)
-        poly_right = array([
-            ((mean_right_lower - lower_x_offset), lower_bound),
-            ((mean_right_upper - upper_x_offset), upper_bound),
-            ((mean_right_upper + upper_x_offset), upper_bound),
-            ((mean_right_lower + lower_x_offset), lower_bound)
-        ])
-    else:
-        poly_right = array(None)
-
-    logger.debug('polygons (left-lane, right-lane):\n(array(%s),\narray(%s))', poly_left, poly_right)
-    return poly_left, poly_right
\ No newline at end of file
+    try:
+        _slope  = signals['slope']
+        _offset = signals['offset']
+        _mean = mean_slope[get_frames(signals)]
+        _index = flatnonzero((_slope != 0) & (absolute(absolute(_slope) - _mean) < slope_variance))
+        _slope = _slope[_index]; _offset = _offset[_index]
+        new_x1 = trunc((lower_bound - _offset) / _slope).astype(int64)
+        new_x2 = trunc((upper_bound - _offset) / _slope).astype(int64)
+        _too_left  = (new_x1 < 0) | (new_x2 < 0)
+        _too_right = (new_x1 > horizontal_limit) | (new_x2 > horizontal_limit)
+        if diagnostics.enabled:
+            if _too_left.any():
+                diagnostics.record('too_far_left', count_nonzero(_too_left), signals[_index[_too_left]])
+            if _too_right.any():
+                diagnostics.record('too_far_right', count_nonzero(_too_right), signals[_index[_too_right]])
+        _kept = flatnonzero(~(_too_left | _too_right))
+        if counters is not None:
+            count(counters, 'segments_off_slope', len(signals) - len(_index))
+            count(counters, 'lines_out_of_bounds', len(_index) - len(_kept))
+            count(counters, 'lines_kept', len(_kept))
+        return signals[_index[_kept]]
+    except Exception as err:
+        logger.error('interpolation error: %s', err)
+        return signals[:0]
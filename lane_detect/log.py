@@ -1,13 +1,18 @@
 import logging
+from collections import deque
 
 DEBUG = False
 ch = logging.StreamHandler()
+# diagnostics defaults
+DIAGNOSTIC_CAPACITY = 256
+DIAGNOSTIC_SAMPLE   = 1
 
 
 def set_debug_flag():
     global DEBUG, logger
     DEBUG = True
     logger = get_logger(__name__)
+    diagnostics.enabled = True
 
 
 def get_logger(name=__name__):
@@ -33,8 +38,80 @@ def get_logger(name=__name__):
         ch.setFormatter(formatter)
         logger.setLevel(logging.INFO)
 
-    logger.addHandler(ch)
+    if ch not in logger.handlers:
+        logger.addHandler(ch)
     return logger
 
 
+class Diagnostics(object):
+    def __init__(self, capacity=DIAGNOSTIC_CAPACITY, sample_every=DIAGNOSTIC_SAMPLE, enabled=False):
+        '''
+        Diagnostics records rejection events instead of logging them one by one.
+        Events are counted per frame, and a sample of their data is kept in a ring buffer.
+        Nothing is formatted until a summary or dump is emitted; callers check
+        diagnostics.enabled first, so the disabled path builds nothing at all.
+        :param capacity: int ring buffer size
+        :param sample_every: int keep data for every Nth event of a kind
+        :param enabled: bool
+        '''
+        self.enabled = enabled
+        self.sample_every = sample_every
+        self.events = deque(maxlen=capacity)
+        self.counts = {}
+        self.totals = {}
+        self._calls = {}
+        self.frame = 0
+
+    def record(self, event: str, n=1, data=None):
+        '''
+        Records n occurrences of event
+        :param event: str event name
+        :param n: int occurrences
+        :param data: optional raw payload (e.g. rejected segments), kept unformatted
+        '''
+        self.counts[event] = self.counts.get(event, 0) + int(n)
+        if data is not None:
+            _calls = self._calls.get(event, 0)
+            self._calls[event] = _calls + 1
+            if _calls % self.sample_every == 0:
+                self.events.append((self.frame, event, data))
+
+    def end_frame(self, level=logging.DEBUG, frames=1):
+        '''
+        Logs one summary line for the frame's events, and starts the next frame
+        :param level: int logging level of the summary
+        :param frames: int frames the events cover, e.g. a batch
+        '''
+        if self.counts:
+            logger.log(level, 'frame %d: %s', self.frame, self.counts)
+            for _event, _n in self.counts.items():
+                self.totals[_event] = self.totals.get(_event, 0) + _n
+            self.counts = {}
+        self.frame = self.frame + frames
+
+    def dump(self) -> list:
+        '''
+        Formats the sampled events in the ring buffer
+        :return: <list> of str
+        '''
+        return ['frame {0}: {1} {2}'.format(_frame, _event, _data) for _frame, _event, _data in self.events]
+
+    def emit(self, level=logging.INFO):
+        '''
+        Logs event totals and the sampled events, on demand
+        :param level: int logging level
+        '''
+        logger.log(level, 'diagnostics over %d frames: %s', self.frame, self.totals)
+        for _line in self.dump():
+            logger.log(level, '  %s', _line)
+
+    def clear(self):
+        self.events.clear()
+        self.counts = {}
+        self.totals = {}
+        self._calls = {}
+        self.frame = 0
+
+
 logger = get_logger(__name__)
+diagnostics = Diagnostics()
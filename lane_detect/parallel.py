@@ -0,0 +1,106 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from numpy import ndarray, dtype
+from lane_detect.log import logger
+
+
+# worker process state, see _init_worker()
+_worker = {}
+
+
+def _init_worker(shm_name: str, shape: tuple, frame_dtype: str, pipeline_kwargs: dict):
+    '''
+    Attaches a pool worker to the shared frame slots and builds its pipeline
+    :param shm_name: shared memory block name
+    :param shape: (slots, height, width, channels)
+    :param frame_dtype: str numpy dtype of frames
+    :param pipeline_kwargs: dict LanePipeline parameters
+    '''
+    from cv2 import setNumThreads
+    from lane_detect.pipeline import LanePipeline
+    setNumThreads(1)  # parallelism comes from the pool
+    shm = SharedMemory(name=shm_name)
+    _worker['shm'] = shm
+    _worker['slots'] = ndarray(shape, dtype=frame_dtype, buffer=shm.buf)
+    _worker['pipeline'] = LanePipeline(**pipeline_kwargs)
+
+
+def _process_slot(slot: int) -> int:
+    '''
+    Runs the pipeline on a shared frame slot, writing the output back in place
+    :param slot: int slot index
+    :return: int slot index
+    '''
+    frame = _worker['slots'][slot]
+    frame[...] = _worker['pipeline'].process(frame)
+    return slot
+
+
+class FramePool(object):
+    def __init__(self, workers: int, window=None, **pipeline_kwargs):
+        '''
+        FramePool fans frames out to a process pool and yields them back in order.
+        Frames are passed through a ring of shared memory slots, not pickled.
+        :param workers: int number of worker processes
+        :param window: int frames in flight (reorder window), default 2 * workers
+        :param pipeline_kwargs: LanePipeline parameters used by every worker
+        '''
+        assert workers > 0, 'need at least one worker'
+        self.workers = workers
+        self.window = window or 2 * workers
+        self.pipeline_kwargs = pipeline_kwargs
+        self.shm = None
+        self.slots = None
+        self.executor = None
+
+    def _start(self, frame: ndarray):
+        '''
+        Allocates the shared slots for frames shaped like frame and starts the workers
+        :param frame: <numpy.ndarray> first frame
+        '''
+        shape = (self.window,) + frame.shape
+        self.shm = SharedMemory(create=True, size=self.window * frame.nbytes)
+        self.slots = ndarray(shape, dtype=frame.dtype, buffer=self.shm.buf)
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(self.shm.name, shape, dtype(frame.dtype).str, self.pipeline_kwargs))
+        logger.debug('started %d workers, %d slots of %s', self.workers, self.window, frame.shape)
+
+    def imap(self, frames):
+        '''
+        Processes frames in parallel, yielding outputs in input order.
+        Yielded frames are views of shared slots, valid until the next frame is requested.
+        :param frames: iterable of <numpy.ndarray> frames, all of one shape
+        :return: generator of <numpy.ndarray>
+        '''
+        pending = deque()
+        for i, frame in enumerate(frames):
+            if self.executor is None:
+                self._start(frame)
+            assert frame.shape == self.slots.shape[1:], 'frames must be same shape, for frame pool'
+            if len(pending) == self.window:
+                yield self.slots[pending.popleft().result()]
+            slot = i % self.window
+            self.slots[slot] = frame
+            pending.append(self.executor.submit(_process_slot, slot))
+        while pending:
+            yield self.slots[pending.popleft().result()]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.shm is not None:
+            self.slots = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,229 @@
+from time import perf_counter
+from numpy import ndarray, pi, empty
+from cv2 import COLOR_RGB2GRAY
+from lane_detect.util import LaneFilter
+from lane_detect.track import LaneTracker
+from lane_detect.lane_fit import FIT_METHODS
+from lane_detect.line_math import get_segments
+from lane_detect.stats import count
+from lane_detect.log import logger
+
+
+# pipeline defaults, same as the CLI utilities
+CANNY_LOWER_BOUND = 50
+CANNY_UPPER_BOUND = 150
+HOUGH_RHO         = 2
+HOUGH_THETA       = pi/180
+HOUGH_THRESH      = 15
+HOUGH_LINE_LEN    = 40
+HOUGH_LINE_GAP    = 10
+
+
+class LanePipeline(object):
+    def __init__(self, canny_lower=CANNY_LOWER_BOUND, canny_upper=CANNY_UPPER_BOUND,
+                 rho=HOUGH_RHO, theta=HOUGH_THETA, threshold=HOUGH_THRESH,
+                 min_line_len=HOUGH_LINE_LEN, max_line_gap=HOUGH_LINE_GAP,
+                 color_order=COLOR_RGB2GRAY, track=False, stats=None, scale=None, target_width=None,
+                 crop=False, color_filter=False, fit_method=FIT_METHODS[0], results=None, cache=None):
+        '''
+        LanePipeline runs the full LaneFilter pipeline over a stream of frames,
+        keeping one LaneFilter session per frame shape so buffers and the ROI
+        mask are allocated once, not per frame
+        :param canny_lower: canny lower bound
+        :param canny_upper: canny upper bound
+        :param rho:          distance resolution in pixels of the Hough grid
+        :param theta:        angular resolution in radians of the Hough grid
+        :param threshold:    minimum number of votes (intersections in Hough grid cell)
+        :param min_line_len: minimum number of pixels to compose line
+        :param max_line_gap: maximum gap in pixels between line segments
+        :param color_order:  int cv2.COLOR_RGB2GRAY, or cv2.COLOR_BGR2GRAY for cv2 frames
+        :param track:        bool track lanes across frames, narrowing the search while locked
+        :param stats:        <RunStats> collects stage times and counters, disabled when None
+        :param scale:        float detect on frames downscaled by this factor, lanes stay full resolution
+        :param target_width: int alternatively, detect on frames downscaled to this width
+        :param crop:         bool detect only within the ROI bounding box
+        :param color_filter: bool keep only edges of white or yellow paint
+        :param fit_method:   str lane fit, 'weighted' least squares or robust 'huber'
+        :param results:      <ResultsWriter> logs every detected frame, disabled when None
+        :param cache:        <ResultCache> repeated frames reuse cached lanes, skipping blur through draw_lines
+        '''
+        self.canny_lower = canny_lower
+        self.canny_upper = canny_upper
+        self.rho = rho
+        self.theta = theta
+        self.threshold = threshold
+        self.min_line_len = min_line_len
+        self.max_line_gap = max_line_gap
+        self.color_order = color_order
+        self.track = track
+        self.stats = stats
+        self.scale = scale
+        self.target_width = target_width
+        self.crop = crop
+        self.color_filter = color_filter
+        self.fit_method = fit_method
+        self.results = results
+        self.cache = cache
+        self.sessions = {}
+        self.trackers = {}
+
+    def get_session(self, frame: ndarray) -> LaneFilter:
+        '''
+        Retrieves the LaneFilter session for the frame shape, created from frame on first use
+        :param frame: <numpy.ndarray> input frame
+        :return: <LaneFilter>
+        '''
+        filter = self.sessions.get(frame.shape)
+        if filter is None:
+            logger.debug('new session for shape %s', frame.shape)
+            filter = LaneFilter(image=frame, scale=self.scale, target_width=self.target_width,
+                                crop=self.crop, color_filter=self.color_filter, fit_method=self.fit_method)
+            filter.stats = self.stats
+            self.sessions[frame.shape] = filter
+        return filter
+
+    def get_filter(self, frame: ndarray) -> LaneFilter:
+        '''
+        Retrieves the LaneFilter session for the frame shape, loaded with frame
+        :param frame: <numpy.ndarray> input frame
+        :return: <LaneFilter>
+        '''
+        filter = self.get_session(frame)
+        filter.load_image(frame, color_order=self.color_order)
+        return filter
+
+    def get_cache_params(self) -> tuple:
+        '''
+        :return: <tuple> parameters lane results depend on, part of the result cache key
+        '''
+        return (self.canny_lower, self.canny_upper, self.rho, self.theta, self.threshold, self.min_line_len,
+                self.max_line_gap, self.color_order, self.scale, self.target_width, self.crop,
+                self.color_filter, self.fit_method)
+
+    def detect(self, frame: ndarray) -> LaneFilter:
+        '''
+        Runs lane detection on a frame, without the final overlay
+        :param frame: <numpy.ndarray> input frame
+        :return: <LaneFilter> session holding left_lane, right_lane and image_tf
+        '''
+        if self.results is not None:
+            _t = perf_counter()
+        filter = self.get_filter(frame)
+        tracker = None
+        if self.track:
+            tracker = self.trackers.get(frame.shape)
+            if tracker is None:
+                tracker = LaneTracker()
+                self.trackers[frame.shape] = tracker
+            filter.set_search_mask(tracker.get_search_mask(filter))
+            if filter.search_mask is not None and self.stats is not None:
+                self.stats.frame.counters['frames_narrowed'] = 1
+        # a narrowed search depends on the tracker, not only on the frame
+        key = None
+        entry = None
+        if self.cache is not None and filter.search_mask is None:
+            key = self.cache.key(frame, self.get_cache_params())
+            entry = self.cache.get(key)
+        if entry is not None:
+            self.cache.restore(filter, entry)
+            if self.stats is not None:
+                self.stats.frame.counters['cache_hits'] = 1
+        else:
+            filter.gaussian_blur()
+            filter.canny_edges(self.canny_lower, self.canny_upper)
+            filter.hough_lines(rho=self.rho, threshold=self.threshold,
+                               min_line_len=self.min_line_len, max_line_gap=self.max_line_gap,
+                               theta=self.theta, with_lines=True)
+            filter.apply_roi_mask()
+            if key is not None:
+                self.cache.put(key, self.cache.capture(filter))
+        if tracker is not None:
+            tracker.update(filter)
+        if self.results is not None:
+            self.results.append(filter, ms=(perf_counter() - _t) * 1000)
+        return filter
+
+    def process(self, frame: ndarray) -> ndarray:
+        '''
+        Runs the full pipeline on a frame.
+        The returned image is a reused buffer, overwritten by the next frame of the same shape.
+        :param frame: <numpy.ndarray> input frame
+        :return: <numpy.ndarray> frame with lane overlay
+        '''
+        return self.detect(frame).weighted_image()
+
+    def redraw(self, frame: ndarray) -> ndarray:
+        '''
+        Overlays the lanes of the last detected frame of the same shape on frame, without detection.
+        The returned image is a reused buffer, see process().
+        :param frame: <numpy.ndarray> input frame
+        :return: <numpy.ndarray> frame with lane overlay, None if no frame of this shape was detected yet
+        '''
+        filter = self.sessions.get(frame.shape)
+        if filter is None:
+            return None
+        filter.image = frame
+        return filter.weighted_image()
+
+    def detect_batch(self, frames: ndarray) -> list:
+        '''
+        Runs lane detection on a stack of frames of one shape, see LaneFilter.process_batch().
+        Frames are detected independently, so tracking does not apply, cached frames are not detected again.
+        :param frames: <numpy.ndarray> (N, H, W, C) input frames
+        :return: <list> per frame <dict> {left_lane, right_lane, lines, roi_filter_lines, slope_filter_lines}
+        '''
+        assert not self.track, 'tracking needs consecutive frames, use detect()'
+        if not len(frames):
+            return []
+        _t = perf_counter()
+        filter = self.get_session(frames[0])
+        results = [None] * len(frames)
+        keys = [None] * len(frames)
+        if self.cache is not None:
+            _params = self.get_cache_params()
+            keys = [self.cache.key(_frame, _params) for _frame in frames]
+            results = [self.cache.get(_key) for _key in keys]
+        _misses = [_i for _i, _result in enumerate(results) if _result is None]
+        if _misses:
+            _batch = frames if len(_misses) == len(frames) else frames[_misses]
+            _detected = filter.process_batch(_batch, self.canny_lower, self.canny_upper, rho=self.rho,
+                                             threshold=self.threshold, min_line_len=self.min_line_len,
+                                             max_line_gap=self.max_line_gap, theta=self.theta,
+                                             color_order=self.color_order)
+            for _i, _result in zip(_misses, _detected):
+                results[_i] = _result
+                if keys[_i] is not None:
+                    self.cache.put(keys[_i], dict(_result, overlay=None))
+        if self.stats is not None and len(_misses) < len(frames):
+            count(self.stats.frame.counters, 'cache_hits', len(frames) - len(_misses))
+        if self.results is not None:
+            _ms = (perf_counter() - _t) * 1000 / len(frames)
+            for _result in results:
+                self.results.append_lanes(_result['left_lane'], _result['right_lane'],
+                                          segments=len(get_segments(_result['lines'])),
+                                          segments_dominant=len(_result['roi_filter_lines']),
+                                          segments_kept=len(_result['slope_filter_lines']), ms=_ms)
+        return results
+
+    def process_batch(self, frames: ndarray, out=None) -> ndarray:
+        '''
+        Runs the full pipeline on a stack of frames of one shape, see detect_batch().
+        With tracking, frames are detected one by one.
+        :param frames: <numpy.ndarray> (N, H, W, C) input frames
+        :param out: <numpy.ndarray> optional (N, H, W, C) output buffer
+        :return: <numpy.ndarray> (N, H, W, C) frames with lane overlay
+        '''
+        if out is None:
+            out = empty(frames.shape, dtype=frames.dtype)
+        assert out.shape == frames.shape, 'output must be same shape as frames'
+        if self.track:
+            for _frame, _out in zip(frames, out):
+                _out[...] = self.process(_frame)
+            return out
+        results = self.detect_batch(frames)
+        if results:
+            filter = self.get_session(frames[0])
+            for _frame, _result, _out in zip(frames, results, out):
+                filter.load_result(_frame, _result, color_order=self.color_order)
+                _out[...] = filter.weighted_image()
+        return out
@@ -1,7 +1,12 @@
-from matplotlib.pyplot import imshow, show, imread, imsave
+from numpy import ndarray
+from cv2 import imread, cvtColor, COLOR_BGR2RGB
+
+
+# matplotlib is imported on first use, so headless runs never load it or a GUI backend
 
 
 def show_image(image, gray=False):
+    from matplotlib.pyplot import imshow, show
     if gray:
         imshow(image, cmap='gray')
     else:
@@ -9,11 +14,23 @@ def show_image(image, gray=False):
     show()
 
 
-def image_read(filename):
-    return imread(filename)
+def image_read(filename: str, color_order=COLOR_BGR2RGB) -> ndarray:
+    '''
+    Reads an image with OpenCV
+    :param filename: str image path
+    :param color_order: int cv2.COLOR_BGR2RGB for RGB, None keeps OpenCV's BGR
+    :return: <numpy.ndarray> uint8 image
+    '''
+    image = imread(filename)
+    if image is None:
+        raise RuntimeError('{0} could not be read.'.format(filename))
+    if color_order is not None:
+        cvtColor(image, color_order, dst=image)
+    return image
 
 
 def image_save(filename, image, gray=False):
+    from matplotlib.pyplot import imsave
     if gray:
         imsave(filename, image, cmap='gray')
     else:
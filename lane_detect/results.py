@@ -0,0 +1,194 @@
+import json
+from os import makedirs
+from os.path import join, getsize, isfile
+from time import time
+from numpy import ndarray, dtype, zeros, empty, memmap, prod, nan, int32, int64, float32, float64
+from lane_detect.line_math import get_segments
+from lane_detect.track import get_lane_line
+from lane_detect.log import logger
+
+
+RESULTS_VERSION = 1
+CHUNK_ROWS = 1024
+META_FILE = 'meta.json'
+# stage times, NaN when instrumentation is disabled
+STAGE_COLUMNS = ('grayscale', 'gaussian_blur', 'canny_edges', 'hough_lines', 'draw_lines',
+                 'apply_roi_mask', 'weighted_image')
+RESULT_COLUMNS = (
+    ('frame', int64, ()),
+    ('timestamp', float64, ()),
+    ('left_slope', float64, ()),      # lane center line y = slope * x + offset, NaN for no lane
+    ('left_offset', float64, ()),
+    ('right_slope', float64, ()),
+    ('right_offset', float64, ()),
+    ('left_polygon', int32, (4, 2)),  # zeros for no lane
+    ('right_polygon', int32, (4, 2)),
+    ('segments', int32, ()),          # hough segments
+    ('segments_dominant', int32, ()), # after find_dominate_signals
+    ('segments_kept', int32, ()),     # after interpolate_dominate_lines
+    ('ms', float32, ())
+) + tuple(('{0}_ms'.format(_stage), float32, ()) for _stage in STAGE_COLUMNS)
+RESULT_DTYPE = dtype([(_name, _type, _shape) for _name, _type, _shape in RESULT_COLUMNS])
+
+
+class ResultsWriter(object):
+    def __init__(self, path: str, fps=None, chunk=CHUNK_ROWS):
+        '''
+        ResultsWriter logs per-frame lane results in a compact columnar format:
+        a directory with one raw little-endian file per column, and a meta.json schema.
+        Rows are buffered and appended to every column file each chunk, so a partly
+        written log stays readable.
+        :param path: str results directory, overwritten
+        :param fps: float frame rate, timestamps are frame / fps, wall clock when None
+        :param chunk: int rows buffered between writes
+        '''
+        self.path = path
+        self.fps = fps
+        self.frames = 0
+        makedirs(path, exist_ok=True)
+        with open(join(path, META_FILE), 'w') as _f:
+            json.dump({
+                'version': RESULTS_VERSION,
+                'fps': fps,
+                'columns': [{'name': _name, 'dtype': dtype(_type).newbyteorder('<').str, 'shape': list(_shape)}
+                            for _name, _type, _shape in RESULT_COLUMNS]
+            }, _f, indent=2)
+        self._files = {_name: open(join(path, '{0}.bin'.format(_name)), 'wb') for _name, _, _ in RESULT_COLUMNS}
+        self._buffer = zeros(chunk, dtype=RESULT_DTYPE)
+        self._rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append_lanes(self, left_lane: ndarray, right_lane: ndarray, segments=0, segments_dominant=0,
+                     segments_kept=0, ms=nan, stage_times=None, timestamp=None):
+        '''
+        Appends one frame
+        :param left_lane: <numpy.ndarray> lane polygon, None for no lane
+        :param right_lane: <numpy.ndarray> lane polygon, None for no lane
+        :param segments: int hough segments
+        :param segments_dominant: int segments after find_dominate_signals
+        :param segments_kept: int segments after interpolate_dominate_lines
+        :param ms: float frame time in milliseconds
+        :param stage_times: dict {stage: seconds}
+        :param timestamp: float seconds, frame / fps or wall clock when None
+        '''
+        _row = self._buffer[self._rows]
+        _row['frame'] = self.frames
+        if timestamp is None:
+            timestamp = self.frames / self.fps if self.fps else time()
+        _row['timestamp'] = timestamp
+        for _side, _lane in (('left', left_lane), ('right', right_lane)):
+            _line = get_lane_line(_lane)
+            _row['{0}_slope'.format(_side)], _row['{0}_offset'.format(_side)] = _line if _line else (nan, nan)
+            _row['{0}_polygon'.format(_side)] = 0 if _lane is None else _lane
+        _row['segments'] = segments
+        _row['segments_dominant'] = segments_dominant
+        _row['segments_kept'] = segments_kept
+        _row['ms'] = ms
+        for _stage in STAGE_COLUMNS:
+            _row['{0}_ms'.format(_stage)] = stage_times[_stage] * 1000 \
+                if stage_times and _stage in stage_times else nan
+        self.frames = self.frames + 1
+        self._rows = self._rows + 1
+        if self._rows == len(self._buffer):
+            self.flush()
+
+    def append(self, filter, ms=nan):
+        '''
+        Appends the lanes and segment counts of a LaneFilter after draw_lines
+        :param filter: <LaneFilter>
+        :param ms: float frame time in milliseconds
+        '''
+        _stats = filter.frame_stats
+        self.append_lanes(filter.left_lane, filter.right_lane,
+                          segments=len(get_segments(filter.lines)),
+                          segments_dominant=0 if filter.roi_filter_lines is None else len(filter.roi_filter_lines),
+                          segments_kept=0 if filter.slope_filter_lines is None else len(filter.slope_filter_lines),
+                          ms=ms, stage_times=None if _stats is None else _stats.times)
+
+    def flush(self):
+        '''
+        Appends buffered rows to the column files
+        '''
+        if not self._rows:
+            return
+        for _name, _file in self._files.items():
+            _file.write(self._buffer[_name][:self._rows].astype(self._buffer.dtype[_name].base.newbyteorder('<')).tobytes())
+            _file.flush()
+        self._rows = 0
+
+    def close(self):
+        if self._files is None:
+            return
+        self.flush()
+        for _file in self._files.values():
+            _file.close()
+        self._files = None
+        logger.info('wrote %d frames of lane results to %s', self.frames, self.path)
+
+
+class ResultsReader(object):
+    def __init__(self, path: str):
+        '''
+        ResultsReader opens a ResultsWriter log, memory mapping each column on first access.
+        Slicing a column only touches the pages of that column.
+        :param path: str results directory
+        '''
+        self.path = path
+        with open(join(path, META_FILE)) as _f:
+            meta = json.load(_f)
+        assert meta['version'] == RESULTS_VERSION, 'unsupported results version {0}'.format(meta['version'])
+        self.fps = meta['fps']
+        self.columns = {_c['name']: (dtype(_c['dtype']), tuple(_c['shape'])) for _c in meta['columns']}
+        self._maps = {}
+        # a log still being written can have columns one chunk apart
+        _frames = []
+        for _name, (_type, _shape) in self.columns.items():
+            _file = self._column_file(_name)
+            _size = getsize(_file) if isfile(_file) else 0
+            _frames.append(_size // (_type.itemsize * int(prod(_shape))))
+        self.frames = min(_frames) if _frames else 0
+
+    def _column_file(self, name: str) -> str:
+        return join(self.path, '{0}.bin'.format(name))
+
+    def __len__(self):
+        return self.frames
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name: str) -> ndarray:
+        '''
+        Memory mapped column
+        :param name: str column name
+        :return: <numpy.memmap> read only, (frames,) + column shape
+        '''
+        _map = self._maps.get(name)
+        if _map is None:
+            _type, _shape = self.columns[name]
+            if not self.frames:
+                return empty((0,) + _shape, dtype=_type)
+            _map = memmap(self._column_file(name), dtype=_type, mode='r', shape=(self.frames,) + _shape)
+            self._maps[name] = _map
+        return _map
+
+    def read(self, index=slice(None), columns=None) -> ndarray:
+        '''
+        Gathers rows into a structured array
+        :param index: slice, int array or bool mask of frames
+        :param columns: list of column names, all when None
+        :return: <numpy.ndarray> structured rows
+        '''
+        if columns is None:
+            columns = list(self.columns)
+        _first = self[columns[0]][index]
+        rows = empty(len(_first), dtype=[(_name,) + self.columns[_name] for _name in columns])
+        rows[columns[0]] = _first
+        for _name in columns[1:]:
+            rows[_name] = self[_name][index]
+        return rows
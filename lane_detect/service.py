@@ -0,0 +1,395 @@
+import asyncio
+import json
+import socket
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from struct import Struct
+from threading import local
+from time import perf_counter
+from numpy import ndarray, array, dtype, frombuffer, percentile, stack, uint8, int32
+from cv2 import COLOR_RGB2GRAY, COLOR_BGR2GRAY
+from lane_detect.pipeline import LanePipeline
+from lane_detect.batch import lane_to_list
+from lane_detect.log import logger
+
+
+# service defaults
+HOST           = '127.0.0.1'
+PORT           = 8765
+MAX_BATCH      = 8
+MAX_WAIT       = 0.005  # seconds a partial batch waits for more frames
+MAX_IN_FLIGHT  = 32     # requests admitted before connections stop being read
+LATENCY_WINDOW = 10000  # latencies kept for percentiles
+PERCENTILES    = (50, 90, 99)
+# messages are a 4 byte header length, a JSON header, then header['nbytes'] of payload
+HEADER      = Struct('!I')
+MAX_HEADER  = 1 << 16
+COLOR_ORDERS = {'rgb': COLOR_RGB2GRAY, 'bgr': COLOR_BGR2GRAY}
+
+# per thread pipelines by color order, see _get_pipeline()
+_local = local()
+
+
+def pack_message(header: dict, payload=b'') -> list:
+    '''
+    :param header: dict JSON serializable header
+    :param payload: bytes-like payload
+    :return: <list> of bytes-like chunks to send
+    '''
+    payload = memoryview(payload).cast('B')
+    header = dict(header, nbytes=payload.nbytes)
+    _header = json.dumps(header).encode()
+    return [HEADER.pack(len(_header)), _header, payload]
+
+
+async def read_header(reader: asyncio.StreamReader) -> dict:
+    _size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if _size > MAX_HEADER:
+        raise ValueError('header of {0} bytes is too large'.format(_size))
+    return json.loads(await reader.readexactly(_size))
+
+
+def _get_pipeline(color_order: str, pipeline_kwargs: dict) -> LanePipeline:
+    if getattr(_local, 'pipelines', None) is None:
+        _local.pipelines = {}
+    pipeline = _local.pipelines.get(color_order)
+    if pipeline is None:
+        pipeline = LanePipeline(color_order=COLOR_ORDERS[color_order], **pipeline_kwargs)
+        _local.pipelines[color_order] = pipeline
+    return pipeline
+
+
+def _detect_batch(frames: list, pipeline_kwargs: dict) -> list:
+    '''
+    Executor task, detects lanes in a micro-batch with this thread's pipelines.
+    Frames of one shape and color order without overlay are detected together with
+    LanePipeline.detect_batch(), overlays and tracking pipelines detect frame by frame.
+    :param frames: list of (frame: ndarray, color_order: str, overlay: bool)
+    :param pipeline_kwargs: dict LanePipeline parameters
+    :return: <list> of (result: dict, overlay: ndarray or None)
+    '''
+    results = [None] * len(frames)
+    groups = {}
+    for _i, (frame, color_order, overlay) in enumerate(frames):
+        if overlay or pipeline_kwargs.get('track'):
+            groups[_i] = [_i]
+        else:
+            groups.setdefault((frame.shape, color_order), []).append(_i)
+    for _indices in groups.values():
+        _t = perf_counter()
+        frame, color_order, overlay = frames[_indices[0]]
+        try:
+            pipeline = _get_pipeline(color_order, pipeline_kwargs)
+            if overlay or pipeline.track:
+                filter = pipeline.detect(frame)
+                _image = filter.weighted_image().copy() if overlay else None
+                _lanes = [(filter.left_lane, filter.right_lane, _image)]
+            else:
+                _lanes = [(_result['left_lane'], _result['right_lane'], None) for _result in
+                          pipeline.detect_batch(stack([frames[_i][0] for _i in _indices]))]
+            _ms = (perf_counter() - _t) * 1000 / len(_indices)
+            for _i, (left_lane, right_lane, _image) in zip(_indices, _lanes):
+                results[_i] = ({
+                    'left_lane': lane_to_list(left_lane),
+                    'right_lane': lane_to_list(right_lane),
+                    'ms': _ms
+                }, _image)
+        except Exception as err:
+            logger.error('detection error: %s', err)
+            for _i in _indices:
+                results[_i] = ({'error': str(err)}, None)
+    return results
+
+
+class LaneService(object):
+    def __init__(self, host=HOST, port=PORT, path=None, workers=1, max_batch=MAX_BATCH, max_wait=MAX_WAIT,
+                 max_in_flight=MAX_IN_FLIGHT, **pipeline_kwargs):
+        '''
+        LaneService serves lane detection over local TCP or a Unix socket.
+        Frames are grouped into micro-batches, up to max_batch frames or max_wait seconds,
+        and detected on a thread pool. At most max_in_flight requests are admitted,
+        further frames are not read until one completes, so producers see backpressure.
+        :param host: str TCP host
+        :param port: int TCP port, 0 picks a free port
+        :param path: str Unix socket path, used instead of TCP when set
+        :param workers: int detection threads
+        :param max_batch: int frames per batch
+        :param max_wait: float seconds a partial batch waits for more frames
+        :param max_in_flight: int admitted requests
+        :param pipeline_kwargs: LanePipeline parameters
+        '''
+        self.host = host
+        self.port = port
+        self.path = path
+        self.workers = workers
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_in_flight = max_in_flight
+        self.pipeline_kwargs = pipeline_kwargs
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched = 0
+        self.in_flight = 0
+        self.server = None
+        self._queue = None
+        self._admit = None
+        self._batcher = None
+        self._executor = None
+
+    @property
+    def address(self):
+        '''
+        :return: str Unix socket path, or (host, port) once started
+        '''
+        if self.path:
+            return self.path
+        if self.server is not None:
+            return self.server.sockets[0].getsockname()[:2]
+        return self.host, self.port
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._admit = asyncio.Semaphore(self.max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='lane-service')
+        if self.path:
+            self.server = await asyncio.start_unix_server(self._handle, path=self.path)
+        else:
+            self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self._batcher = asyncio.create_task(self._run_batches())
+        logger.info('serving lane detection on %s, %d workers, batches of %d within %.1f ms',
+                    self.address, self.workers, self.max_batch, self.max_wait * 1000)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self._batcher is not None:
+            self._batcher.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self.log_stats()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    def run(self):
+        '''
+        Serves until interrupted
+        '''
+        try:
+            asyncio.run(self.serve_forever())
+        except KeyboardInterrupt:
+            pass
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            _deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                _timeout = _deadline - loop.time()
+                if _timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), _timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batches = self.batches + 1
+            self.batched = self.batched + len(batch)
+            _future = loop.run_in_executor(self._executor, _detect_batch,
+                                           [_item[:3] for _item in batch], self.pipeline_kwargs)
+            _future.add_done_callback(partial(self._resolve, batch))
+
+    @staticmethod
+    def _resolve(batch: list, future: asyncio.Future):
+        if future.exception() is not None:
+            for _item in batch:
+                if not _item[3].done():
+                    _item[3].set_exception(future.exception())
+            return
+        for _item, _result in zip(batch, future.result()):
+            if not _item[3].done():
+                _item[3].set_result(_result)
+
+    async def _send(self, writer: asyncio.StreamWriter, lock: asyncio.Lock, header: dict, payload=b''):
+        async with lock:
+            writer.writelines(pack_message(header, payload))
+            await writer.drain()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                try:
+                    header = await read_header(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                if header.get('op', 'detect') == 'stats':
+                    await reader.readexactly(header.get('nbytes', 0))
+                    await self._send(writer, lock, {'id': header.get('id'), 'stats': self.stats()})
+                    continue
+                _t = perf_counter()
+                await self._admit.acquire()
+                try:
+                    payload = await reader.readexactly(header.get('nbytes', 0))
+                except BaseException:
+                    self._admit.release()
+                    raise
+                _task = asyncio.create_task(self._respond(header, payload, writer, lock, _t))
+                tasks.add(_task)
+                _task.add_done_callback(tasks.discard)
+        except (ConnectionError, ValueError) as err:
+            logger.error('connection error: %s', err)
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+    async def _respond(self, header: dict, payload: bytes, writer: asyncio.StreamWriter,
+                       lock: asyncio.Lock, start: float):
+        self.in_flight = self.in_flight + 1
+        try:
+            image = None
+            try:
+                shape = tuple(header['shape'])
+                assert dtype(header.get('dtype', '|u1')) == uint8, 'frames must be uint8'
+                assert len(shape) == 3 and shape[2] == 3, 'frames must be (height, width, 3)'
+                color_order = header.get('color_order', 'rgb')
+                assert color_order in COLOR_ORDERS, 'color_order must be one of {0}'.format(list(COLOR_ORDERS))
+                frame = frombuffer(payload, dtype=uint8).reshape(shape)
+                _future = asyncio.get_running_loop().create_future()
+                self._queue.put_nowait((frame, color_order, bool(header.get('overlay')), _future))
+                result, image = await _future
+            except Exception as err:
+                result = {'error': str(err)}
+            self.requests = self.requests + 1
+            if 'error' in result:
+                self.errors = self.errors + 1
+            result['id'] = header.get('id')
+            _payload = b''
+            if image is not None:
+                result['overlay'] = {'shape': image.shape, 'dtype': image.dtype.str}
+                _payload = image.data
+            await self._send(writer, lock, result, _payload)
+            self.latencies.append((perf_counter() - start) * 1000)
+        finally:
+            self.in_flight = self.in_flight - 1
+            self._admit.release()
+
+    def stats(self) -> dict:
+        '''
+        :return: <dict> {requests, errors, batches, mean_batch, in_flight, latency_ms: {p50, p90, p99, mean}}
+        '''
+        _latency = {}
+        if self.latencies:
+            _ms = array(self.latencies)
+            _latency = {'p{0}'.format(_p): float(percentile(_ms, _p)) for _p in PERCENTILES}
+            _latency['mean'] = float(_ms.mean())
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'batches': self.batches,
+            'mean_batch': self.batched / self.batches if self.batches else 0.0,
+            'in_flight': self.in_flight,
+            'latency_ms': _latency
+        }
+
+    def log_stats(self):
+        _stats = self.stats()
+        logger.info('%d requests, %d errors, %d batches of %.1f frames on average',
+                    _stats['requests'], _stats['errors'], _stats['batches'], _stats['mean_batch'])
+        if _stats['latency_ms']:
+            logger.info('latency %s', ', '.join('{0}: {1:.2f} ms'.format(_k, _v)
+                                                 for _k, _v in _stats['latency_ms'].items()))
+
+
+class LaneClient(object):
+    def __init__(self, host=HOST, port=PORT, path=None, timeout=None):
+        '''
+        LaneClient is a blocking client of LaneService.
+        detect() waits for each frame; submit() and receive() keep several frames in flight.
+        :param host: str TCP host
+        :param port: int TCP port
+        :param path: str Unix socket path, used instead of TCP when set
+        :param timeout: float socket timeout in seconds
+        '''
+        if path:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection((host, port), timeout=timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self.sock.makefile('rb')
+        self._id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+        self.sock.close()
+
+    def _receive_message(self) -> (dict, bytes):
+        _head = self._file.read(HEADER.size)
+        if len(_head) < HEADER.size:
+            raise ConnectionError('service closed the connection')
+        _size, = HEADER.unpack(_head)
+        header = json.loads(self._file.read(_size))
+        return header, self._file.read(header.get('nbytes', 0))
+
+    def submit(self, frame: ndarray, overlay=False, color_order='rgb') -> int:
+        '''
+        Sends a frame without waiting for its result
+        :param frame: <numpy.ndarray> (height, width, 3) uint8
+        :param overlay: bool also return the frame with the lane overlay
+        :param color_order: str 'rgb' or 'bgr'
+        :return: int request id
+        '''
+        self._id = self._id + 1
+        if not frame.flags.c_contiguous:
+            frame = frame.copy()
+        self.sock.sendall(b''.join(pack_message({
+            'op': 'detect', 'id': self._id, 'shape': frame.shape, 'dtype': frame.dtype.str,
+            'overlay': overlay, 'color_order': color_order
+        }, frame.data)))
+        return self._id
+
+    def receive(self) -> dict:
+        '''
+        Waits for the next result, results of submitted frames may arrive in any order
+        :return: <dict> {id, left_lane, right_lane, ms, overlay} lanes are int32 polygons or None,
+                 overlay is an ndarray when requested; {id, error} on failure
+        '''
+        header, payload = self._receive_message()
+        header.pop('nbytes', None)
+        for _lane in ('left_lane', 'right_lane'):
+            if header.get(_lane) is not None:
+                header[_lane] = array(header[_lane], dtype=int32)
+        if 'overlay' in header:
+            _meta = header['overlay']
+            header['overlay'] = frombuffer(payload, dtype=_meta['dtype']).reshape(_meta['shape'])
+        return header
+
+    def detect(self, frame: ndarray, overlay=False, color_order='rgb') -> dict:
+        '''
+        Detects lanes in a frame, see receive()
+        '''
+        self.submit(frame, overlay, color_order)
+        return self.receive()
+
+    def stats(self) -> dict:
+        self._id = self._id + 1
+        self.sock.sendall(b''.join(pack_message({'op': 'stats', 'id': self._id})))
+        return self._receive_message()[0]['stats']
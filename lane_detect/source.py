@@ -0,0 +1,98 @@
+import mmap
+from os.path import getsize
+from numpy import ndarray, dtype, memmap, load, prod, uint8
+from cv2 import cvtColor, COLOR_RGB2GRAY, COLOR_BGR2GRAY, COLOR_GRAY2RGB
+from lane_detect.log import logger
+
+
+COLOR_ORDERS = ('rgb', 'bgr', 'gray')
+NPY_EXTENSION = '.npy'
+
+
+def parse_shape(text: str) -> tuple:
+    '''
+    :param text: str frame shape 'HEIGHTxWIDTH' or 'HEIGHTxWIDTHxCHANNELS', e.g. '540x960x3'
+    :return: <tuple> of int
+    '''
+    return tuple(int(_n) for _n in text.lower().split('x'))
+
+
+class FrameStack(object):
+    def __init__(self, filename: str, shape=None, color_order=None, frame_dtype=uint8, offset=0, fps=None):
+        '''
+        FrameStack memory maps a stack of raw frames (video/x-raw), so frames are paged in
+        from the file as the pipeline reads them, without decoding or copying.
+        .npy stacks (N, H, W[, C]) carry their shape; headerless raw files need the frame
+        shape, and their frame count follows from the file size.
+        RGB and BGR frames are zero-copy views, pass color_code to the pipeline.
+        Gray frames are expanded to RGB, which copies.
+        :param filename: str .npy or raw file
+        :param shape: tuple frame shape (H, W) or (H, W, 3) of raw files
+        :param color_order: str 'rgb', 'bgr' or 'gray', default 'gray' for 2-d frames, else 'rgb'
+        :param frame_dtype: raw file pixel type, uint8
+        :param offset: int raw file header bytes to skip
+        :param fps: float frame rate, when the stack is encoded to a video
+        '''
+        self.filename = filename
+        self.fps = fps
+        if filename.lower().endswith(NPY_EXTENSION):
+            frames = load(filename, mmap_mode='r')
+            assert frames.ndim in (3, 4), '{0} must hold a stack of frames, not {1}'.format(filename, frames.shape)
+        else:
+            assert shape, 'raw frame stacks need the frame shape'
+            shape = tuple(shape)
+            _frame_bytes = int(prod(shape)) * dtype(frame_dtype).itemsize
+            _count, _rest = divmod(getsize(filename) - offset, _frame_bytes)
+            if _rest:
+                logger.warning('%s ends with a partial frame of %d bytes, ignored', filename, _rest)
+            assert _count, '{0} holds no {1} frames'.format(filename, shape)
+            frames = memmap(filename, dtype=frame_dtype, mode='r', offset=offset, shape=(_count,) + shape)
+        if frames.ndim == 4 and frames.shape[3] == 1:
+            frames = frames[..., 0]
+        assert frames.dtype == uint8, 'frames must be uint8, not {0}'.format(frames.dtype)
+        if color_order is None:
+            color_order = 'gray' if frames.ndim == 3 else 'rgb'
+        assert color_order in COLOR_ORDERS, 'color_order must be one of {0}'.format(COLOR_ORDERS)
+        assert (frames.ndim == 3) == (color_order == 'gray') and (frames.ndim == 3 or frames.shape[3] == 3), \
+            '{0} frames of shape {1} are not {2}'.format(filename, frames.shape[1:], color_order)
+        # frames are read front to back, let the kernel read ahead
+        _mmap = getattr(frames, '_mmap', None)
+        if _mmap is not None and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            _mmap.madvise(mmap.MADV_SEQUENTIAL)
+        self.frames = frames
+        self.color_order = color_order
+        logger.debug('mapped %d %s frames of %s from %s', len(frames), color_order, frames.shape[1:], filename)
+
+    @property
+    def color_code(self) -> int:
+        '''
+        :return: int LanePipeline color_order of the frames this stack yields
+        '''
+        return COLOR_BGR2GRAY if self.color_order == 'bgr' else COLOR_RGB2GRAY
+
+    @property
+    def size(self) -> tuple:
+        '''
+        :return: <tuple> (width, height)
+        '''
+        return self.frames.shape[2], self.frames.shape[1]
+
+    def __repr__(self):
+        return '{0} ({1} {2} frames)'.format(self.filename, len(self.frames), self.color_order)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index: int) -> ndarray:
+        '''
+        :param index: int frame
+        :return: <numpy.ndarray> read only view of the mapped frame, an RGB copy of gray frames
+        '''
+        frame = self.frames[index]
+        if self.color_order == 'gray':
+            return cvtColor(frame, COLOR_GRAY2RGB)
+        return frame
+
+    def __iter__(self):
+        for _index in range(len(self.frames)):
+            yield self[_index]
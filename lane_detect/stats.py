@@ -0,0 +1,190 @@
+from collections import Counter
+from contextlib import contextmanager
+from cProfile import Profile
+from functools import wraps
+from io import StringIO
+from pstats import Stats
+from sys import _current_frames
+from threading import Thread, Event, get_ident
+from time import perf_counter
+from lane_detect.log import logger
+
+
+PROFILE_MODES = ('cprofile', 'sampling')
+PROFILE_TOP = 25
+SAMPLE_INTERVAL = 0.005
+
+
+def timed(stage: str):
+    '''
+    Records a LaneFilter method's wall time into self.stats, when instrumentation is enabled
+    :param stage: str stage name
+    '''
+    def decorate(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.stats is None:
+                return method(self, *args, **kwargs)
+            _t = perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.stats.add_time(stage, perf_counter() - _t)
+        return wrapper
+    return decorate
+
+
+def count(counters: dict, name: str, n=1):
+    '''
+    Increments a counter, when counters are collected
+    :param counters: dict counters or None
+    :param name: str counter name
+    :param n: int increment
+    '''
+    if counters is not None:
+        counters[name] = counters.get(name, 0) + int(n)
+
+
+class FrameStats(object):
+    def __init__(self):
+        '''
+        FrameStats holds stage wall times (seconds) and counters for one frame
+        '''
+        self.times = {}
+        self.counters = {}
+
+    def __bool__(self):
+        return bool(self.times or self.counters)
+
+    def as_dict(self) -> dict:
+        return {
+            'times_ms': {_stage: _t * 1000 for _stage, _t in self.times.items()},
+            'counters': dict(self.counters)
+        }
+
+
+class RunStats(object):
+    def __init__(self):
+        '''
+        RunStats collects FrameStats from LaneFilter instances and aggregates them over a run.
+        Pass one RunStats to every LaneFilter (or LanePipeline) that should report into it.
+        '''
+        self.frames = 0
+        self.times = {}
+        self.max_times = {}
+        self.counters = {}
+        self.frame = FrameStats()
+
+    def start_frame(self) -> FrameStats:
+        '''
+        Folds the current frame into the run, and starts a new one
+        :return: <FrameStats> new current frame
+        '''
+        if self.frame:
+            self.frames = self.frames + 1
+            for _stage, _t in self.frame.times.items():
+                self.times[_stage] = self.times.get(_stage, 0.0) + _t
+                self.max_times[_stage] = max(self.max_times.get(_stage, 0.0), _t)
+            for _name, _n in self.frame.counters.items():
+                self.counters[_name] = self.counters.get(_name, 0) + _n
+        self.frame = FrameStats()
+        return self.frame
+
+    def add_time(self, stage: str, seconds: float):
+        self.frame.times[stage] = self.frame.times.get(stage, 0.0) + seconds
+
+    def lap(self, stage: str, start: float) -> float:
+        '''
+        Records time since start for stage
+        :return: float perf_counter() now, start of the next lap
+        '''
+        _now = perf_counter()
+        self.add_time(stage, _now - start)
+        return _now
+
+    def summary(self) -> dict:
+        '''
+        Aggregate over all frames, including the current one
+        :return: <dict> {frames, fps, stages: {stage: {mean_ms, max_ms, total_ms}}, counters, counters_per_frame}
+        '''
+        self.start_frame()
+        _frames = max(self.frames, 1)
+        # sub-stages are named '<stage>.<step>' and already counted in their stage
+        _top = [_stage for _stage in self.times if '.' not in _stage]
+        _total = sum(self.times[_stage] for _stage in _top)
+        return {
+            'frames': self.frames,
+            'fps': self.frames / _total if _total else 0.0,
+            'stages': {_stage: {
+                'mean_ms': self.times[_stage] * 1000 / _frames,
+                'max_ms': self.max_times[_stage] * 1000,
+                'total_ms': self.times[_stage] * 1000
+            } for _stage in self.times},
+            'counters': dict(self.counters),
+            'counters_per_frame': {_name: _n / _frames for _name, _n in self.counters.items()}
+        }
+
+    def log_summary(self):
+        _summary = self.summary()
+        logger.info('%d frames, %.1f fps', _summary['frames'], _summary['fps'])
+        for _stage, _t in _summary['stages'].items():
+            logger.info('  %-40s mean: %8.3f ms  max: %8.3f ms', _stage, _t['mean_ms'], _t['max_ms'])
+        for _name, _n in _summary['counters'].items():
+            logger.info('  %-40s total: %9d  per frame: %8.2f', _name, _n, _summary['counters_per_frame'][_name])
+
+
+def _sample_stacks(thread_id: int, samples: Counter, stop: Event, interval: float):
+    while not stop.wait(interval):
+        samples[None] = samples[None] + 1
+        _frame = _current_frames().get(thread_id)
+        _seen = set()
+        while _frame is not None:
+            _code = _frame.f_code
+            _key = '{0}:{1}({2})'.format(_code.co_filename, _code.co_firstlineno, _code.co_name)
+            if _key not in _seen:
+                samples[_key] = samples[_key] + 1
+                _seen.add(_key)
+            _frame = _frame.f_back
+
+
+@contextmanager
+def profile(output=None, mode='cprofile', interval=SAMPLE_INTERVAL):
+    '''
+    Profiles the enclosed block of the calling thread
+    :param output: str file for cProfile stats (pstats format), logged when None
+    :param mode: str 'cprofile' deterministic, or 'sampling' low overhead stack sampling
+    :param interval: float seconds between samples, for 'sampling'
+    '''
+    assert mode in PROFILE_MODES, 'profile mode must be one of {0}'.format(PROFILE_MODES)
+    if mode == 'cprofile':
+        _profile = Profile()
+        _profile.enable()
+        try:
+            yield _profile
+        finally:
+            _profile.disable()
+            if output:
+                _profile.dump_stats(output)
+                logger.info('wrote profile to %s', output)
+            else:
+                _stream = StringIO()
+                Stats(_profile, stream=_stream).sort_stats('cumulative').print_stats(PROFILE_TOP)
+                logger.info('profile:\n%s', _stream.getvalue())
+        return
+    samples = Counter(); stop = Event()
+    _sampler = Thread(target=_sample_stacks, args=(get_ident(), samples, stop, interval),
+                      name='lane-profile', daemon=True)
+    _sampler.start()
+    try:
+        yield samples
+    finally:
+        stop.set()
+        _sampler.join()
+        _total = max(samples.pop(None, 0), 1)
+        _lines = ['{0:6.1f}%  {1}'.format(_n * 100 / _total, _key) for _key, _n in samples.most_common(PROFILE_TOP)]
+        if output:
+            with open(output, 'w') as _f:
+                _f.write('\n'.join(_lines) + '\n')
+            logger.info('wrote profile to %s', output)
+        else:
+            logger.info('sampled profile (inclusive):\n%s', '\n'.join(_lines))
@@ -0,0 +1,205 @@
+from os import environ
+from queue import Queue, Empty, Full
+from subprocess import Popen, PIPE, DEVNULL
+from threading import Thread, Event
+from cv2 import VideoCapture, VideoWriter, VideoWriter_fourcc, cvtColor, \
+    COLOR_BGR2RGB, COLOR_RGB2BGR, COLOR_RGB2GRAY, COLOR_BGR2GRAY, \
+    CAP_PROP_FPS, CAP_PROP_FRAME_WIDTH, CAP_PROP_FRAME_HEIGHT
+from lane_detect.pipeline import LanePipeline
+from lane_detect.source import FrameStack
+from lane_detect.log import logger
+
+
+QUEUE_SIZE   = 8
+QUEUE_POLL   = 0.1
+DEFAULT_FPS  = 25.0
+FOURCC       = 'mp4v'
+FFMPEG_BIN   = environ.get('IMAGEIO_FFMPEG_EXE', 'ffmpeg')
+_END = None
+
+
+class VideoStream(object):
+    def __init__(self, source: str, output: str, pipeline=None, frame_pool=None,
+                 queue_size=QUEUE_SIZE, use_ffmpeg=False):
+        '''
+        VideoStream runs decode -> detect -> encode as three overlapping stages,
+        connected by bounded queues so memory stays flat on long inputs
+        :param source: str input video, or a <FrameStack> of raw frames
+        :param output: str output video
+        :param pipeline: <LanePipeline> detection stage, default parameters if None,
+                         frames are decoded to BGR instead of RGB for a BGR pipeline
+        :param frame_pool: <FramePool> optional process pool used instead of pipeline
+        :param queue_size: int frames buffered between stages
+        :param use_ffmpeg: bool encode through an ffmpeg pipe instead of cv2.VideoWriter
+        '''
+        self.source = source
+        self.output = output
+        if pipeline is None:
+            _color_order = source.color_code if isinstance(source, FrameStack) else COLOR_RGB2GRAY
+            pipeline = LanePipeline(color_order=_color_order)
+        self.pipeline = pipeline
+        self.frame_pool = frame_pool
+        if frame_pool is not None:
+            _color_order = frame_pool.pipeline_kwargs.get('color_order', COLOR_RGB2GRAY)
+        else:
+            _color_order = pipeline.color_order
+        self.bgr = _color_order == COLOR_BGR2GRAY
+        self.use_ffmpeg = use_ffmpeg
+        self.decoded = Queue(maxsize=queue_size)
+        self.detected = Queue(maxsize=queue_size)
+        self.stop = Event()
+        self.errors = []
+        self.frames = 0
+
+    def _put(self, queue: Queue, item) -> bool:
+        '''
+        Blocks on a full queue (backpressure) until there is room or the stream stops
+        :return: True if item was queued
+        '''
+        while not self.stop.is_set():
+            try:
+                queue.put(item, timeout=QUEUE_POLL)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _get(self, queue: Queue):
+        '''
+        Blocks on an empty queue until an item arrives or the stream stops
+        :return: item, or _END when stopped
+        '''
+        while not self.stop.is_set():
+            try:
+                return queue.get(timeout=QUEUE_POLL)
+            except Empty:
+                continue
+        return _END
+
+    def _fail(self, stage: str, err: Exception):
+        logger.error('%s stage failed: %s', stage, err)
+        self.errors.append(err)
+        self.stop.set()
+
+    def _read(self, capture: VideoCapture):
+        '''
+        Decode stage, frames are converted to RGB unless the pipeline takes BGR
+        '''
+        try:
+            while not self.stop.is_set():
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                if not self.bgr:
+                    cvtColor(frame, COLOR_BGR2RGB, dst=frame)
+                if not self._put(self.decoded, frame):
+                    break
+        except Exception as err:
+            self._fail('decode', err)
+        finally:
+            capture.release()
+            self._put(self.decoded, _END)
+
+    def _read_stack(self):
+        '''
+        Read stage of a FrameStack, queues zero-copy views of the mapped frames
+        '''
+        try:
+            for frame in self.source:
+                if not self._put(self.decoded, frame):
+                    break
+        except Exception as err:
+            self._fail('read', err)
+        finally:
+            self._put(self.decoded, _END)
+
+    def _decoded_frames(self):
+        frame = self._get(self.decoded)
+        while frame is not _END:
+            yield frame
+            frame = self._get(self.decoded)
+
+    def _detect(self):
+        '''
+        Detection stage, runs in the calling thread.
+        Pipeline outputs are reused buffers, the BGR conversion doubles as the copy.
+        '''
+        _encode = (lambda _lane: _lane.copy()) if self.bgr else (lambda _lane: cvtColor(_lane, COLOR_RGB2BGR))
+        try:
+            if self.frame_pool is not None:
+                lanes = self.frame_pool.imap(self._decoded_frames())
+            else:
+                lanes = map(self.pipeline.process, self._decoded_frames())
+            for lane in lanes:
+                if not self._put(self.detected, _encode(lane)):
+                    break
+        except Exception as err:
+            self._fail('detect', err)
+        finally:
+            self._put(self.detected, _END)
+
+    def _open_writer(self, fps: float, size: tuple):
+        if self.use_ffmpeg:
+            width, height = size
+            return Popen([FFMPEG_BIN, '-y', '-loglevel', 'error',
+                          '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+                          '-s', '{0}x{1}'.format(width, height), '-r', str(fps),
+                          '-i', '-', '-pix_fmt', 'yuv420p', self.output],
+                         stdin=PIPE, stdout=DEVNULL, stderr=PIPE)
+        writer = VideoWriter(self.output, VideoWriter_fourcc(*FOURCC), fps, size)
+        assert writer.isOpened(), 'could not open {0} for writing'.format(self.output)
+        return writer
+
+    def _write(self, fps: float, size: tuple):
+        '''
+        Encode stage
+        '''
+        writer = None
+        try:
+            writer = self._open_writer(fps, size)
+            frame = self._get(self.detected)
+            while frame is not _END:
+                if self.use_ffmpeg:
+                    writer.stdin.write(frame.data)
+                else:
+                    writer.write(frame)
+                self.frames = self.frames + 1
+                frame = self._get(self.detected)
+        except Exception as err:
+            self._fail('encode', err)
+        finally:
+            if writer is None:
+                pass
+            elif self.use_ffmpeg:
+                # closes stdin, ffmpeg finalizes the file before it exits
+                _, _err = writer.communicate()
+                if writer.returncode:
+                    self._fail('encode', RuntimeError('ffmpeg could not write {0}: {1}'.format(
+                        self.output, _err.decode().strip())))
+            else:
+                writer.release()
+
+    def run(self) -> int:
+        '''
+        Processes the whole source video into output
+        :return: int number of frames written
+        '''
+        if isinstance(self.source, FrameStack):
+            fps = self.source.fps or DEFAULT_FPS
+            size = self.source.size
+            reader = Thread(target=self._read_stack, name='lane-read', daemon=True)
+        else:
+            capture = VideoCapture(self.source)
+            if not capture.isOpened():
+                raise RuntimeError('{0} could not be opened.'.format(self.source))
+            fps = capture.get(CAP_PROP_FPS) or DEFAULT_FPS
+            size = (int(capture.get(CAP_PROP_FRAME_WIDTH)), int(capture.get(CAP_PROP_FRAME_HEIGHT)))
+            reader = Thread(target=self._read, args=(capture,), name='lane-decode', daemon=True)
+        writer = Thread(target=self._write, args=(fps, size), name='lane-encode', daemon=True)
+        reader.start(); writer.start()
+        self._detect()
+        writer.join(); reader.join()
+        if self.errors:
+            raise self.errors[0]
+        logger.debug('streamed %d frames from %s', self.frames, self.source)
+        return self.frames
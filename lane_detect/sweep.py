@@ -0,0 +1,190 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from time import perf_counter
+from numpy import ndarray, array
+from cv2 import Canny, HoughLinesP
+from lane_detect.util import LaneFilter
+from lane_detect.cache import LRUCache, CACHE_BYTES
+from lane_detect.line_math import find_dominate_signals, find_mean_slope, interpolate_dominate_lines, \
+    get_segments, SLOPE_THRESHOLD, SLOPE_VARIANCE, MAGNITUDE_THRESH
+from lane_detect.lane_fit import fit_lanes
+from lane_detect.pipeline import CANNY_LOWER_BOUND, CANNY_UPPER_BOUND, \
+    HOUGH_RHO, HOUGH_THETA, HOUGH_THRESH, HOUGH_LINE_LEN, HOUGH_LINE_GAP
+from lane_detect.batch import lane_to_list
+from lane_detect.log import logger
+
+
+# parameters in pipeline order, each stage's output depends only on its own and earlier parameters
+CANNY_PARAMS = ('canny_lower', 'canny_upper')
+HOUGH_PARAMS = ('rho', 'theta', 'threshold', 'min_line_len', 'max_line_gap')
+LINE_PARAMS  = ('slope_thresh', 'slope_variance', 'magnitude_thresh')
+DEFAULT_PARAMS = {
+    'canny_lower': CANNY_LOWER_BOUND,
+    'canny_upper': CANNY_UPPER_BOUND,
+    'rho': HOUGH_RHO,
+    'theta': HOUGH_THETA,
+    'threshold': HOUGH_THRESH,
+    'min_line_len': HOUGH_LINE_LEN,
+    'max_line_gap': HOUGH_LINE_GAP,
+    'slope_thresh': SLOPE_THRESHOLD,
+    'slope_variance': SLOPE_VARIANCE,
+    'magnitude_thresh': MAGNITUDE_THRESH
+}
+
+
+def expand_grid(grid: dict, names: tuple) -> list:
+    '''
+    Cartesian product of the grid values of names, defaults for names not in the grid
+    :param grid: dict {parameter: value or list of values}
+    :param names: parameter names
+    :return: <list> of tuples of values, in names order
+    '''
+    _values = []
+    for _name in names:
+        _value = grid.get(_name, DEFAULT_PARAMS[_name])
+        _values.append(_value if isinstance(_value, (list, tuple)) else [_value])
+    return list(product(*_values))
+
+
+def find_lanes(lines: ndarray, region_mask: ndarray, lower_bound: int, upper_bound: int,
+               horizontal_limit: int, slope_thresh=SLOPE_THRESHOLD, slope_variance=SLOPE_VARIANCE,
+               magnitude_thresh=MAGNITUDE_THRESH) -> (ndarray, ndarray):
+    '''
+    The LaneFilter.draw_lines line_math steps, with tunable thresholds
+    :param lines: <numpy.ndarray> hough segments
+    :param region_mask: ROI mask, first channel
+    :return: <tuple> (left_lane, right_lane) polygons, None for no lane
+    '''
+    signals, mean_slope = find_dominate_signals(lines, region_mask, slope_thresh=slope_thresh,
+                                                magnitude_thresh=magnitude_thresh)
+    mean_slope = find_mean_slope(signals, mean_slope)
+    signals = interpolate_dominate_lines(signals, mean_slope, lower_bound, upper_bound, horizontal_limit,
+                                         slope_variance=slope_variance)
+    return fit_lanes(signals, lower_bound, upper_bound)
+
+
+class ParameterSweep(object):
+    def __init__(self, images: dict, jobs=1, cache_bytes=CACHE_BYTES):
+        '''
+        ParameterSweep runs the lane pipeline over a grid of parameters.
+        Stage outputs are memoized in a memory bounded LRU: each blurred image is shared by
+        all Canny settings, and each Canny output by all Hough settings. The cache is kept
+        between runs, so refining a grid only computes the new stages.
+        :param images: dict {name: RGB image}
+        :param jobs: int parallel (Canny, Hough) settings
+        :param cache_bytes: int memory budget of stage outputs
+        '''
+        self.jobs = jobs
+        self.cache = LRUCache(cache_bytes)
+        self.frames = {}
+        for _name, _image in images.items():
+            filter = LaneFilter(image=_image)
+            lower_bound, upper_bound = filter.get_lane_bounds()
+            self.frames[_name] = {
+                'filter': filter,
+                'region_mask': filter.get_roi_mask()[..., 0].copy(),
+                'bounds': (lower_bound, upper_bound),
+                'horizontal_limit': _image.shape[1] - 1
+            }
+
+    def _stage(self, key: tuple, compute) -> (object, float):
+        '''
+        Memoized stage output
+        :param key: tuple stage, image and parameters
+        :param compute: callable computing the output on a miss
+        :return: <tuple> (output, float milliseconds it took to compute)
+        '''
+        _entry = self.cache.get(key)
+        if _entry is None:
+            _t = perf_counter()
+            _output = compute()
+            _entry = (_output, (perf_counter() - _t) * 1000)
+            self.cache.put(key, _entry)
+        return _entry
+
+    def _blur(self, name: str) -> (ndarray, float):
+        def _compute():
+            return self.frames[name]['filter'].gaussian_blur(image=self.frames[name]['filter'].gray)
+        return self._stage(('blur', name), _compute)
+
+    def _canny(self, name: str, canny: tuple) -> (ndarray, float):
+        def _compute():
+            blur, _ = self._blur(name)
+            return Canny(blur, *canny)
+        return self._stage(('canny', name, canny), _compute)
+
+    def _hough(self, name: str, canny: tuple, hough: tuple) -> (ndarray, float):
+        def _compute():
+            edges, _ = self._canny(name, canny)
+            rho, theta, threshold, min_line_len, max_line_gap = hough
+            return get_segments(HoughLinesP(edges, rho, theta, threshold, array([]),
+                                            minLineLength=min_line_len, maxLineGap=max_line_gap))
+        return self._stage(('hough', name, canny, hough), _compute)
+
+    def _run_hough(self, canny: tuple, hough: tuple, line_params: list) -> list:
+        '''
+        All line_math settings for one Canny and Hough setting, over all images
+        :return: <list> of ((canny, hough, line), {image: (left_lane, right_lane, times)})
+        '''
+        _outputs = {_line: {} for _line in line_params}
+        for _name, _frame in self.frames.items():
+            _, blur_ms = self._blur(_name)
+            _, canny_ms = self._canny(_name, canny)
+            segments, hough_ms = self._hough(_name, canny, hough)
+            for _line in line_params:
+                _t = perf_counter()
+                left_lane, right_lane = find_lanes(segments, _frame['region_mask'], *_frame['bounds'],
+                                                   _frame['horizontal_limit'], *_line)
+                _times = {
+                    'gaussian_blur': blur_ms,
+                    'canny_edges': canny_ms,
+                    'hough_lines': hough_ms,
+                    'line_math': (perf_counter() - _t) * 1000
+                }
+                _outputs[_line][_name] = (left_lane, right_lane, _times)
+        return [((canny, hough, _line), _outputs[_line]) for _line in line_params]
+
+    def run(self, grid: dict) -> list:
+        '''
+        Runs every combination of the grid
+        :param grid: dict {parameter: value or list of values}, see DEFAULT_PARAMS
+        :return: <list> of <dict> {params, lanes: {image: {left_lane, right_lane}}, lanes_found,
+                 ms: {stage: mean milliseconds per image, total}}, cached stages report the
+                 time they took when computed
+        '''
+        unknown = set(grid) - set(DEFAULT_PARAMS)
+        assert not unknown, 'unknown parameters {0}, choose from {1}'.format(sorted(unknown), list(DEFAULT_PARAMS))
+        cannys = expand_grid(grid, CANNY_PARAMS)
+        houghs = expand_grid(grid, HOUGH_PARAMS)
+        line_params = expand_grid(grid, LINE_PARAMS)
+        logger.info('sweeping %d combinations over %d images with %d threads',
+                    len(cannys) * len(houghs) * len(line_params), len(self.frames), self.jobs)
+        _t = perf_counter()
+        with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='lane-sweep') as executor:
+            # blur and Canny outputs are shared by many combinations, memoize them once before fanning out,
+            # so parallel combinations do not compute the same stage side by side
+            list(executor.map(self._blur, self.frames))
+            list(executor.map(lambda _args: self._canny(*_args), product(self.frames, cannys)))
+            _batches = list(executor.map(lambda _pair: self._run_hough(*_pair, line_params),
+                                         product(cannys, houghs)))
+        results = []
+        for (canny, hough, _line), _outputs in (_r for _batch in _batches for _r in _batch):
+            _params = dict(zip(CANNY_PARAMS + HOUGH_PARAMS + LINE_PARAMS, canny + hough + _line))
+            _images = max(len(_outputs), 1)
+            _ms = {}
+            for _, _, _times in _outputs.values():
+                for _stage, _time in _times.items():
+                    _ms[_stage] = _ms.get(_stage, 0.0) + _time / _images
+            _ms['total'] = sum(_ms.values())
+            results.append({
+                'params': _params,
+                'lanes': {_name: {'left_lane': lane_to_list(_left), 'right_lane': lane_to_list(_right)}
+                          for _name, (_left, _right, _) in _outputs.items()},
+                'lanes_found': sum((_left is not None) + (_right is not None) for _left, _right, _ in _outputs.values()),
+                'ms': _ms
+            })
+        _stats = self.cache.stats()
+        logger.info('swept in %.2f s, stage cache: %d entries, %.1f MB, %.0f%% hits, %d evictions',
+                    perf_counter() - _t, _stats['entries'], _stats['bytes'] / 2**20,
+                    _stats['hit_rate'] * 100, _stats['evictions'])
+        return results
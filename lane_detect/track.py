@@ -0,0 +1,114 @@
+from numpy import ndarray, array, int32, uint8, zeros
+from cv2 import fillPoly
+from lane_detect.log import logger
+
+
+# tracking thresholds
+SMOOTHING        = 0.5   # weight of the newest measurement
+LOCK_FRAMES      = 3     # consecutive detections before narrowing the search
+MAX_MISSES       = 2     # consecutive misses before falling back to the full ROI
+MAX_SLOPE_JUMP   = 0.2   # larger slope changes are treated as misses
+MAX_X_JUMP       = 40    # larger bottom x changes are treated as misses
+# search band half widths, wider at the bottom where lanes are closer
+BAND_UPPER_WIDTH = 20
+BAND_LOWER_WIDTH = 60
+BAND_MARGIN      = 40    # segments may start above the ROI
+LANES = ('left_lane', 'right_lane')
+
+
+def get_lane_line(polygon: ndarray) -> (float, float):
+    '''
+    Center line of a lane polygon from lane_fit.fit_lanes
+    :param polygon: <numpy.ndarray> 4 (x, y) vertices, or None for no lane
+    :return: <tuple> (slope: float, offset: float), None if no lane
+    '''
+    if polygon is None:
+        return None
+    (x1, y1), (x2, y2) = (polygon[0] + polygon[3]) / 2, (polygon[1] + polygon[2]) / 2
+    if x1 == x2 or y1 == y2:
+        return None
+    slope = (y2 - y1) / (x2 - x1)
+    return slope, y1 - x1 * slope
+
+
+class LaneTracker(object):
+    def __init__(self, smoothing=SMOOTHING, lock_frames=LOCK_FRAMES, max_misses=MAX_MISSES):
+        '''
+        LaneTracker carries lane lines (slope, offset) across frames, and narrows
+        the search region of the next frame to bands around them while locked
+        :param smoothing: float weight of the newest measurement
+        :param lock_frames: int consecutive detections before narrowing
+        :param max_misses: int consecutive misses before falling back to the full ROI
+        '''
+        self.smoothing = smoothing
+        self.lock_frames = lock_frames
+        self.max_misses = max_misses
+        self.mask = None
+        self.reset()
+
+    def reset(self):
+        self.lanes = dict.fromkeys(LANES)
+        self.hits = dict.fromkeys(LANES, 0)
+        self.misses = dict.fromkeys(LANES, 0)
+
+    @property
+    def locked(self) -> bool:
+        return all(self.hits[_lane] >= self.lock_frames for _lane in LANES)
+
+    def update(self, filter) -> bool:
+        '''
+        Smooths lanes detected by filter into the tracked state
+        :param filter: <LaneFilter> after draw_lines
+        :return: bool True if locked
+        '''
+        _, upper_bound = filter.get_lane_bounds()
+        for _lane in LANES:
+            _line = get_lane_line(getattr(filter, _lane))
+            _prev = self.lanes[_lane]
+            if _line is not None and _prev is not None:
+                _jump = abs((upper_bound - _line[1]) / _line[0] - (upper_bound - _prev[1]) / _prev[0])
+                if abs(_line[0] - _prev[0]) > MAX_SLOPE_JUMP or _jump > MAX_X_JUMP:
+                    logger.debug('%s jumped from %s to %s', _lane, _prev, _line)
+                    _line = None
+            if _line is None:
+                self.misses[_lane] = self.misses[_lane] + 1
+                if self.misses[_lane] > self.max_misses:
+                    if self.locked:
+                        logger.debug('lost lock on %s, searching full ROI', _lane)
+                    self.lanes[_lane] = None
+                    self.hits[_lane] = 0
+                continue
+            if _prev is None:
+                self.lanes[_lane] = _line
+            else:
+                self.lanes[_lane] = tuple(
+                    self.smoothing * _new + (1 - self.smoothing) * _old for _new, _old in zip(_line, _prev))
+            self.hits[_lane] = self.hits[_lane] + 1
+            self.misses[_lane] = 0
+        return self.locked
+
+    def get_search_mask(self, filter) -> ndarray:
+        '''
+        Bands around the predicted lanes
+        :param filter: <LaneFilter> loaded with the next frame
+        :return: <numpy.ndarray> single channel mask, None when not locked
+        '''
+        if not self.locked:
+            return None
+        lower_bound, upper_bound = filter.get_lane_bounds()
+        lower_bound = lower_bound - BAND_MARGIN
+        if self.mask is None or self.mask.shape != filter.gray.shape:
+            self.mask = zeros(filter.gray.shape, dtype=uint8)
+        else:
+            self.mask.fill(0)
+        for _lane in LANES:
+            _slope, _offset = self.lanes[_lane]
+            x_upper = (lower_bound - _offset) / _slope
+            x_lower = (upper_bound - _offset) / _slope
+            fillPoly(self.mask, [array([
+                (x_upper - BAND_UPPER_WIDTH, lower_bound),
+                (x_upper + BAND_UPPER_WIDTH, lower_bound),
+                (x_lower + BAND_LOWER_WIDTH, upper_bound),
+                (x_lower - BAND_LOWER_WIDTH, upper_bound)
+            ], dtype=int32)], 255)
+        return self.mask
@@ -1,26 +1,54 @@
 from os.path import isfile
-from numpy import array, ndarray, uint8, int32, pi, \
-    zeros, zeros_like, count_nonzero
+from numpy import array, ndarray, uint8, int32, float64, pi, \
+    zeros, zeros_like, ones, count_nonzero, minimum, copyto, ascontiguousarray
 from cv2 import Canny, GaussianBlur, HoughLinesP, \
-    imread, cvtColor, COLOR_BGR2GRAY, COLOR_RGB2GRAY, \
-    fillPoly, bitwise_and, addWeighted
+    imread, cvtColor, COLOR_BGR2GRAY, COLOR_RGB2GRAY, COLOR_BGR2HSV, COLOR_RGB2HSV, \
+    fillPoly, bitwise_and, bitwise_or, addWeighted, convertScaleAbs, boundingRect, resize, INTER_LINEAR, INTER_NEAREST, \
+    inRange, dilate
 from lane_detect.line_math import find_dominate_signals, find_mean_slope, interpolate_dominate_lines, \
-    convert_lane_edges_to_polygons
+    find_dominate_signals_batch, find_mean_slope_batch, interpolate_dominate_lines_batch, split_batch
+from lane_detect.lane_fit import fit_lanes, fit_lanes_batch, FIT_METHODS
 from lane_detect.plot import image_read, image_save
-from lane_detect.log import logger
+from lane_detect.stats import timed, count
+from lane_detect.log import logger, diagnostics
+from time import perf_counter
+
+
+# rows kept above the ROI when cropping, lane segments may start above it
+CROP_MARGIN = 40
+# lane colors in OpenCV HSV, hue 0-180
+WHITE_LOWER  = array([0, 0, 150], dtype=uint8)
+WHITE_UPPER  = array([180, 80, 255], dtype=uint8)
+YELLOW_LOWER = array([10, 80, 100], dtype=uint8)
+YELLOW_UPPER = array([40, 255, 255], dtype=uint8)
+COLOR_DILATE = 7  # edges lie on the boundary of the paint, grow the mask to reach them
+# lane fill color, RGB, reversed on BGR frames
+LANE_COLOR = (255, 0, 0)
 
 
 class LaneFilter(object):
-    def __init__(self, image=None, filename=None, use_cv2_imread=False):
+    def __init__(self, image=None, filename=None, use_cv2_imread=False, stats=None,
+                 scale=None, target_width=None, crop=False, color_filter=False, fit_method=FIT_METHODS[0]):
         '''
         LaneFilter will perform image transforms on itself
         :param image: <numpy.ndarray>
         :param filename: file path <str>
+        :param stats: <RunStats> collects stage times and counters, disabled when None
+        :param scale: float blur, Canny and Hough run at this scale of the image, see set_scale()
+        :param target_width: int alternatively, blur, Canny and Hough run at this width
+        :param crop: bool process only the ROI bounding box, see set_crop()
+        :param color_filter: bool keep only edges of white or yellow paint, see set_color_filter()
+        :param fit_method: str lane fit, see lane_fit.fit_lanes()
         '''
+        self.stats = stats
+        if stats is not None:
+            stats.start_frame()
         if filename:
             assert issubclass(str, type(filename)), 'image path must be <str>'
             if isfile(filename):
+                self.color_order = COLOR_RGB2GRAY
                 if use_cv2_imread:
+                    self.color_order = COLOR_BGR2GRAY
                     self.image = imread(filename)
                     self.gray = self.grayscale(image=self.image, color_order=COLOR_BGR2GRAY)
                 else:
@@ -33,8 +61,9 @@ class LaneFilter(object):
                 msg = '{0} not found.'.format(filename)
                 RuntimeError(msg)
         elif count_nonzero(image):
-            assert issubclass(ndarray, type(image)), 'image must be <numpy.ndarray>'
+            assert isinstance(image, ndarray), 'image must be <numpy.ndarray>'
             self.image = image
+            self.color_order = COLOR_RGB2GRAY
             self.image_tf = zeros_like(self.image)
             self.gray = self.grayscale(image=self.image)
             self.mask = zeros_like(self.image)
@@ -51,11 +80,201 @@ class LaneFilter(object):
             (int(x_width / 2 + self.X_OFFSET), int(y_height / 2 + self.Y_OFFSET)),
             (x_width - 1, y_height - 1)
         ], dtype=int32)
+        # reusable per-frame buffers, see load_image()
+        self._overlay = self.image_tf
+        self._crop = None
+        self._crop_outside = ()
+        self.color_filter = color_filter
+        self.fit_method = fit_method
+        self.set_scale(scale, target_width)
+        if crop:
+            self.set_crop(crop)
+        self._roi_poly = None
+        self._roi_current = False
+        self._batch_gray = None
         self.left_lane  = None
         self.right_lane = None
-        self.roi_filter_lines = {}
-        self.slope_filter_lines = {}
+        self.lines = None
+        self.roi_filter_lines = None
+        self.slope_filter_lines = None
+
+    def load_image(self, image: ndarray, color_order=COLOR_RGB2GRAY) -> ndarray:
+        '''
+        Loads a new frame of the same shape, reusing all buffers and the ROI mask
+        :param image: <numpy.ndarray> next frame
+        :param color_order: int cv2.COLOR_RGB2GRAY or cv2.COLOR_BGR2GRAY
+        :return: <numpy.ndarray> grayscale frame
+        '''
+        assert isinstance(image, ndarray), 'image must be <numpy.ndarray>'
+        assert image.shape == self.image.shape, 'images must be same shape, to reuse filter'
+        if self.stats is not None:
+            self.stats.start_frame()
+        self.image = image
+        self.color_order = color_order
+        self.image_tf = self._overlay
+        self._roi_current = False
+        self.left_lane  = None
+        self.right_lane = None
+        self.lines = None
+        self.roi_filter_lines = None
+        self.slope_filter_lines = None
+        return self.grayscale(color_order=color_order)
+
+    def set_crop(self, crop=True, margin=CROP_MARGIN):
+        '''
+        Restricts the pipeline to a zero-copy view of the ROI bounding box.
+        Grayscale, blur, Canny and the ROI mask skip the pixels outside it, Hough segments
+        are offset back to frame coordinates, and only the box is composited with lanes.
+        :param crop: bool
+        :param margin: int rows kept above the ROI
+        '''
+        self._crop = None
+        self._crop_outside = ()
+        if crop:
+            [y_height, x_width] = self.gray.shape
+            x, y, w, h = boundingRect(self.roi)
+            y, h = max(0, y - margin), h + min(y, margin)
+            self._crop = (slice(y, y + h), slice(x, x + w))
+            _outside = [
+                (slice(0, y), slice(None)),
+                (slice(y + h, y_height), slice(None)),
+                (slice(y, y + h), slice(0, x)),
+                (slice(y, y + h), slice(x + w, x_width))
+            ]
+            self._crop_outside = tuple(_rect for _rect in _outside if all(
+                len(range(*_s.indices(_n))) for _s, _n in zip(_rect, (y_height, x_width))))
+            # nothing is drawn outside the box from now on
+            self._overlay.fill(0)
+            self.mask.fill(0)
+            self._roi_current = False
+        self.set_scale(self.scale)
+
+    def set_scale(self, scale=None, target_width=None):
+        '''
+        Sets the processing scale, blur, Canny and Hough run on a downscaled grayscale image.
+        Hough thresholds in pixels scale with it, and segments are mapped back to full
+        resolution before line_math filtering, so overlays are still drawn at full resolution.
+        :param scale: float in (0, 1], None or 1 for native resolution
+        :param target_width: int processing width, used when scale is None
+        '''
+        [y_height, x_width] = self.gray.shape
+        if scale is None and target_width:
+            scale = target_width / x_width
+        if scale is None or scale >= 1:
+            scale = 1.0
+        assert scale > 0, 'processing scale must be positive'
+        self.scale = scale
+        self._small = None
+        if self._crop is not None:
+            [y_height, x_width] = self.gray[self._crop].shape
+        if scale < 1:
+            self._small = zeros((max(1, round(y_height * scale)), max(1, round(x_width * scale))), dtype=uint8)
+        _shape = self.get_processing_shape()
+        self._blur = zeros(_shape, dtype=uint8)
+        self._edges = zeros(_shape, dtype=uint8)
+        self.set_search_mask(None)
+        self.set_color_filter(self.color_filter)
+
+    def set_color_filter(self, enabled=True):
+        '''
+        Keeps only Canny edges on or next to white or yellow paint, so shadows, pavement
+        seams and cars produce fewer Hough segments
+        :param enabled: bool
+        '''
+        self.color_filter = enabled
+        self._hsv = None
+        self._color = None
+        if enabled:
+            _image = self.image if self._crop is None else self.image[self._crop]
+            self._hsv = zeros_like(_image)
+            self._white = zeros(_image.shape[:2], dtype=uint8)
+            self._yellow = zeros(_image.shape[:2], dtype=uint8)
+            self._color = self._yellow
+            if self._small is not None:
+                self._color = zeros(self._small.shape, dtype=uint8)
+            self._color_kernel = ones((COLOR_DILATE, COLOR_DILATE), dtype=uint8)
+
+    def get_processing_shape(self) -> tuple:
+        '''
+        Shape of the blur, Canny and Hough images
+        :return: <tuple> (height, width)
+        '''
+        if self._small is not None:
+            return self._small.shape
+        if self._crop is not None:
+            return self.gray[self._crop].shape
+        return self.gray.shape
+
+    def get_processing_gray(self) -> ndarray:
+        '''
+        Grayscale image at the processing scale
+        :return: <numpy.ndarray>
+        '''
+        gray = self.gray
+        if self._crop is not None:
+            gray = gray[self._crop]
+        if self._small is None:
+            return gray
+        [y_height, x_width] = self._small.shape
+        return resize(gray, (x_width, y_height), dst=self._small, interpolation=INTER_LINEAR)
+
+    def to_frame_coords(self, lines: ndarray) -> ndarray:
+        '''
+        Maps Hough segments from processing to full resolution coordinates
+        :param lines: <numpy.ndarray> segments (x1, y1, x2, y2), or None
+        :return: <numpy.ndarray> int32 segments
+        '''
+        if lines is None or (self.scale == 1 and self._crop is None):
+            return lines
+        x, y = 0, 0
+        if self._crop is not None:
+            x, y = self._crop[1].start, self._crop[0].start
+        if self.scale == 1:
+            return lines + array([x, y] * 2, dtype=lines.dtype)
+        [y_height, x_width] = self.gray.shape
+        _lines = ((lines.astype(float64) + 0.5) / self.scale - 0.5).round() + array([x, y] * 2)
+        _lines = minimum(_lines.clip(0), array([x_width - 1, y_height - 1] * 2))
+        return _lines.astype(int32)
+
+    def set_search_mask(self, mask=None):
+        '''
+        Narrows blur, Canny and Hough to a search region, e.g. bands around tracked lanes
+        :param mask: <numpy.ndarray> single channel mask, None restores the full ROI
+        '''
+        if mask is None:
+            self.search_mask = None
+            self._search_rect = None
+            return
+        assert mask.shape == self.gray.shape, 'search mask must match grayscale shape'
+        if self._crop is not None:
+            mask = mask[self._crop]
+        if self._small is not None:
+            [y_height, x_width] = self._small.shape
+            mask = resize(mask, (x_width, y_height), interpolation=INTER_NEAREST)
+        self.search_mask = mask
+        x, y, w, h = boundingRect(mask)
+        self._search_rect = (slice(y, y + h), slice(x, x + w))
+
+    def get_lane_bounds(self) -> (int, int):
+        '''
+        Vertical extent of drawn lanes
+        :return: <tuple> (lower_bound: int top y value, upper_bound: int bottom y value)
+        '''
+        upper_bound = int(self.image.shape[0] - 1)
+        lower_bound = int(upper_bound/2 + self.Y_OFFSET)
+        return lower_bound, upper_bound
 
+    @property
+    def frame_stats(self):
+        '''
+        Stage times and counters of the current frame
+        :return: <FrameStats>, None when instrumentation is disabled
+        '''
+        if self.stats is None:
+            return None
+        return self.stats.frame
+
+    @timed('grayscale')
     def grayscale(self, image=None, color_order=COLOR_RGB2GRAY) -> ndarray:
         '''
         Applies the Grayscale transform
@@ -65,11 +284,15 @@ class LaneFilter(object):
         :return: <numpy.ndarray>
         '''
         if image is not None:
-            assert issubclass(ndarray, type(image)), 'image must be <numpy.ndarray>'
+            assert isinstance(image, ndarray), 'image must be <numpy.ndarray>'
             return cvtColor(image, color_order)
-        self.gray = cvtColor(self.image, color_order)
+        if self._crop is not None:
+            cvtColor(self.image[self._crop], color_order, dst=self.gray[self._crop])
+            return self.gray
+        self.gray = cvtColor(self.image, color_order, dst=self.gray)
         return self.gray
 
+    @timed('gaussian_blur')
     def gaussian_blur(self, image=None, kernel=(5,5)) -> ndarray:
         '''
         Applies a Gaussian Noise kernel
@@ -78,11 +301,20 @@ class LaneFilter(object):
         :return: <numpy.ndarray>
         '''
         if image is not None:
-            assert issubclass(ndarray, type(image)), 'image must be <numpy.ndarray>, for gaussian blur'
+            assert isinstance(image, ndarray), 'image must be <numpy.ndarray>, for gaussian blur'
             return GaussianBlur(image, kernel, 0)
-        self.image_tf = GaussianBlur(self.gray, kernel, 0)
+        gray = self.get_processing_gray()
+        if self.scale != 1:
+            # odd kernel, shrunk with the image so thin lane markings are not blurred away
+            kernel = tuple(max(3, int(round(_k * self.scale)) | 1) for _k in kernel)
+        if self._search_rect is not None:
+            GaussianBlur(gray[self._search_rect], kernel, 0, dst=self._blur[self._search_rect])
+            self.image_tf = self._blur
+            return self.image_tf
+        self.image_tf = GaussianBlur(gray, kernel, 0, dst=self._blur)
         return self.image_tf
 
+    @timed('canny_edges')
     def canny_edges(self, low_threshold: int, high_threshold: int, image=None) -> ndarray:
         '''
         Applies the Canny transform
@@ -92,12 +324,43 @@ class LaneFilter(object):
         :return: <numpy.ndarray>
         '''
         if image is None:
-            self.image_tf = Canny(self.image_tf, low_threshold, high_threshold)
+            if self._search_rect is not None and self.image_tf is self._blur:
+                # edges only within the search region, nothing outside it reaches hough
+                self._edges.fill(0)
+                Canny(self._blur[self._search_rect], low_threshold, high_threshold,
+                      edges=self._edges[self._search_rect])
+                self.image_tf = bitwise_and(self._edges, self.search_mask, dst=self._edges)
+            else:
+                self.image_tf = Canny(self.image_tf, low_threshold, high_threshold, edges=self._edges)
+            if self.color_filter:
+                if self.stats is not None:
+                    self.stats.frame.counters['edge_pixels_canny'] = count_nonzero(self.image_tf)
+                self.image_tf = bitwise_and(self.image_tf, self.color_mask(), dst=self.image_tf)
+            if self.stats is not None:
+                self.stats.frame.counters['edge_pixels'] = count_nonzero(self.image_tf)
             return  self.image_tf
         else:
-            assert issubclass(ndarray, type(image)), 'image must be <numpy.ndarray>, for canny edges'
+            assert isinstance(image, ndarray), 'image must be <numpy.ndarray>, for canny edges'
         return Canny(image, low_threshold, high_threshold)
 
+    @timed('canny_edges.color_mask')
+    def color_mask(self) -> ndarray:
+        '''
+        White or yellow paint mask, at the processing scale
+        :return: <numpy.ndarray> single channel mask
+        '''
+        _image = self.image if self._crop is None else self.image[self._crop]
+        _code = COLOR_BGR2HSV if self.color_order == COLOR_BGR2GRAY else COLOR_RGB2HSV
+        hsv = cvtColor(_image, _code, dst=self._hsv)
+        inRange(hsv, WHITE_LOWER, WHITE_UPPER, dst=self._white)
+        inRange(hsv, YELLOW_LOWER, YELLOW_UPPER, dst=self._yellow)
+        bitwise_or(self._white, self._yellow, dst=self._white)
+        dilate(self._white, self._color_kernel, dst=self._yellow)
+        if self._small is not None:
+            [y_height, x_width] = self._small.shape
+            return resize(self._yellow, (x_width, y_height), dst=self._color, interpolation=INTER_NEAREST)
+        return self._color
+
     def get_roi_mask(self, image=None, vertices=None) -> ndarray:
         '''
         Masks a region of interest
@@ -105,14 +368,37 @@ class LaneFilter(object):
         :param vertices: numpy.ndarray of (x,y) tuples
         :return: <numpy.ndarray>
         '''
+        if image is None and vertices is None:
+            # default ROI is filled once, and masked once per loaded frame
+            if not self._roi_current:
+                if self._roi_poly is None:
+                    self._roi_poly = self.get_roi_poly(self.image, self.roi)
+                if self._crop is not None:
+                    bitwise_and(self.image[self._crop], self._roi_poly[self._crop], dst=self.mask[self._crop])
+                else:
+                    self.mask = bitwise_and(self.image, self._roi_poly, dst=self.mask)
+                self._roi_current = True
+            return self.mask
         if image is None:
             image = self.image
         else:
-            assert issubclass(ndarray, type(image)), 'image must be <numpy.ndarray>, to get roi mask'
-        #defining a blank mask to start with
+            assert isinstance(image, ndarray), 'image must be <numpy.ndarray>, to get roi mask'
         if vertices is None:
             vertices = self.roi
-        self.mask = zeros_like(image)
+        # image only where mask pixels are nonzero
+        self.mask = bitwise_and(image, self.get_roi_poly(image, vertices))
+        self._roi_current = False
+        return self.mask
+
+    def get_roi_poly(self, image: ndarray, vertices: ndarray) -> ndarray:
+        '''
+        Fills a blank mask with the region of interest polygon
+        :param image:    numpy.ndarray shape and type of mask
+        :param vertices: numpy.ndarray of (x,y) tuples
+        :return: <numpy.ndarray>
+        '''
+        #defining a blank mask to start with
+        _mask = zeros_like(image)
         # defining a 3 channel or 1 channel color to fill the mask with depending on the input image
         if len(image.shape) > 2:
             [_, _, channels] = image.shape # i.e. 3 or 4 depending on your image
@@ -121,19 +407,22 @@ class LaneFilter(object):
             _mask_color = 255
         # filling pixels inside the polygon defined by "vertices" with the fill color
         if vertices.dtype.name != 'int32':
-            fillPoly(self.mask, int32([vertices]), _mask_color)
+            fillPoly(_mask, int32([vertices]), _mask_color)
         else:
-            fillPoly(self.mask, [vertices], _mask_color)
-        # image only where mask pixels are nonzero
-        self.mask = bitwise_and(image, self.mask)
-        return self.mask
+            fillPoly(_mask, [vertices], _mask_color)
+        return _mask
 
+    @timed('apply_roi_mask')
     def apply_roi_mask(self, image=None):
         if image is not None:
             assert self.image.shape == image.shape, 'images must be same shape, for roi to work'
             self.image_tf = image
-        self.image_tf = bitwise_and(self.image_tf, self.get_roi_mask())
+        if self._crop is not None and self.image_tf is self._overlay:
+            bitwise_and(self._overlay[self._crop], self.get_roi_mask()[self._crop], dst=self._overlay[self._crop])
+            return
+        self.image_tf = bitwise_and(self.image_tf, self.get_roi_mask(), dst=self._overlay)
 
+    @timed('draw_lines')
     def draw_lines(self, lines: ndarray, image=None, color=None, thickness=2) -> ndarray:
         '''
         Lines are drawn on the image inplace.
@@ -148,33 +437,86 @@ class LaneFilter(object):
             assert image.shape == self.image.shape, 'images must be same shape, to draw lines'
             self.image_tf = image
         y_height, x_width, channels = self.image.shape
-        self.image_tf = zeros((y_height, x_width, channels), dtype=uint8)
-        # assign default color
-        if color is None:
-            color = [255, 0, 0]
-        # draw lines
-        logger.debug('-------------------------------------------------------------')
+        canvas, origin = self._lane_canvas()
         # use accumulated signals
-        region_mask  = array(self.get_roi_mask(), dtype=bool)
-        upper_bound  = int(y_height - 1)
-        lower_bound  = int(upper_bound/2 + self.Y_OFFSET)
+        region_mask  = self.get_roi_mask()[..., 0]
+        lower_bound, upper_bound = self.get_lane_bounds()
         horizontal_limit = (x_width - 1)
+        stats = self.stats
+        counters = None
+        if stats is not None:
+            counters = stats.frame.counters
+            _t = perf_counter()
         # quantify signals
-        mean_slope = find_dominate_signals(lines, self.roi_filter_lines, region_mask)
+        self.lines = lines
+        self.roi_filter_lines, mean_slope = find_dominate_signals(lines, region_mask, counters=counters)
+        if stats is not None:
+            _t = stats.lap('draw_lines.find_dominate_signals', _t)
         mean_slope = find_mean_slope(self.roi_filter_lines, mean_slope)
-        # extend lines into lanes
-        interpolate_dominate_lines(self.roi_filter_lines, self.slope_filter_lines,
-                                   mean_slope, lower_bound, upper_bound, horizontal_limit)
-        self.right_lane, self.left_lane = convert_lane_edges_to_polygons(self.slope_filter_lines, lower_bound, upper_bound)
+        if stats is not None:
+            _t = stats.lap('draw_lines.find_mean_slope', _t)
+        # keep lines that extend into lanes, and fit one lane per side
+        self.slope_filter_lines = interpolate_dominate_lines(self.roi_filter_lines, mean_slope, lower_bound,
+                                                             upper_bound, horizontal_limit, counters=counters)
+        if stats is not None:
+            _t = stats.lap('draw_lines.interpolate_dominate_lines', _t)
+        self.left_lane, self.right_lane = fit_lanes(self.slope_filter_lines, lower_bound, upper_bound,
+                                                    method=self.fit_method)
+        if stats is not None:
+            stats.lap('draw_lines.fit_lanes', _t)
+            counters['lanes'] = int(self.left_lane is not None) + int(self.right_lane is not None)
         # fill lane polygons on images
-        if self.right_lane.any():
-            fillPoly(self.image_tf, int32([self.right_lane]), color)
-        else:
+        self._fill_lanes(canvas, origin, color)
+        if self.right_lane is None:
             logger.error('did not create right-side lane')
-        if self.left_lane.any():
-            fillPoly(self.image_tf, int32([self.left_lane]), color)
-        else:
+        if self.left_lane is None:
             logger.error('did not create left-side lane')
+        if diagnostics.enabled:
+            diagnostics.end_frame()
+        return self.image_tf
+
+    def _lane_canvas(self) -> (ndarray, tuple):
+        '''
+        Clears the overlay, lanes are drawn on the whole overlay, or on the crop view shifted to its origin
+        :return: <tuple> (canvas: ndarray, origin: (x, y) offset of lane vertices)
+        '''
+        canvas, origin = self._overlay, (0, 0)
+        if self._crop is not None:
+            canvas = self._overlay[self._crop]
+            origin = (-self._crop[1].start, -self._crop[0].start)
+        canvas.fill(0)
+        self.image_tf = self._overlay
+        return canvas, origin
+
+    def _fill_lanes(self, canvas: ndarray, origin: tuple, color=None):
+        # assign default color, in the frame's channel order
+        if color is None:
+            color = LANE_COLOR[::-1] if self.color_order == COLOR_BGR2GRAY else LANE_COLOR
+        if self.right_lane is not None:
+            fillPoly(canvas, [self.right_lane], color, offset=origin)
+        if self.left_lane is not None:
+            fillPoly(canvas, [self.left_lane], color, offset=origin)
+
+    def set_lanes(self, left_lane: ndarray, right_lane: ndarray, overlay=None, color=None) -> ndarray:
+        '''
+        Sets lanes without detecting them, e.g. from a cache.
+        Lanes are filled on the overlay as draw_lines does, apply_roi_mask() is still required,
+        unless a copy of a finished overlay is given.
+        :param left_lane: <numpy.ndarray> lane polygon, None for no lane
+        :param right_lane: <numpy.ndarray> lane polygon, None for no lane
+        :param overlay: <numpy.ndarray> finished overlay of these lanes, copied
+        :param color: tuple (r, g, b) uint8
+        :return: <numpy.ndarray> overlay
+        '''
+        self.left_lane = left_lane
+        self.right_lane = right_lane
+        if overlay is not None:
+            assert overlay.shape == self._overlay.shape, 'overlay must be same shape'
+            copyto(self._overlay, overlay)
+            self.image_tf = self._overlay
+            return self.image_tf
+        canvas, origin = self._lane_canvas()
+        self._fill_lanes(canvas, origin, color)
         return self.image_tf
 
     def hough_lines(self, rho: float, threshold: int, min_line_len: float, max_line_gap: float,
@@ -193,12 +535,141 @@ class LaneFilter(object):
         if image is None:
             image = self.image_tf
         else:
-            assert issubclass(ndarray, type(image)), 'image must be <numpy.ndarray>, for hough tf'
-        hough_tf = HoughLinesP(image, rho, theta, threshold, array([]), minLineLength=min_line_len, maxLineGap=max_line_gap)
+            assert isinstance(image, ndarray), 'image must be <numpy.ndarray>, for hough tf'
+        if self.scale != 1 and image.shape == self._edges.shape:
+            # thresholds in pixels shrink with the image
+            rho = max(1, rho * self.scale)
+            threshold = max(1, int(round(threshold * self.scale)))
+            min_line_len = min_line_len * self.scale
+            max_line_gap = max_line_gap * self.scale
+        hough_tf = self._hough(image, rho, theta, threshold, min_line_len, max_line_gap)
+        if image.shape == self._edges.shape:
+            # segments are mapped back to full resolution frame coordinates
+            hough_tf = self.to_frame_coords(hough_tf)
         if with_lines:
             return self.draw_lines(lines=hough_tf)
         return hough_tf
 
+    @timed('hough_lines')
+    def _hough(self, image, rho, theta, threshold, min_line_len, max_line_gap) -> ndarray:
+        return HoughLinesP(image, rho, theta, threshold, array([]), minLineLength=min_line_len, maxLineGap=max_line_gap)
+
+    def process_batch(self, frames: ndarray, low_threshold: int, high_threshold: int, rho: float, threshold: int,
+                      min_line_len: float, max_line_gap: float, theta=pi/180, color_order=COLOR_RGB2GRAY) -> list:
+        '''
+        Detects lanes on a stack of frames of this filter's shape.
+        Color conversion runs once over the whole stack, blur, Canny and Hough per frame,
+        and the Hough segments of all frames are concatenated, tagged with their frame, so
+        draw_lines' ROI masking, filtering and lane fitting run vectorized across the batch.
+        Results match detecting the frames one by one, use load_result() to draw them.
+        The filter keeps its loaded frame, stage times, counters and diagnostics of the batch
+        wide stages are recorded on the last frame.
+        :param frames: <numpy.ndarray> (N, H, W, C) frames, e.g. a FrameStack slice, not copied when contiguous
+        :param low_threshold:  canny lower bound
+        :param high_threshold: canny upper bound
+        :param rho:            distance resolution in pixels of the Hough grid
+        :param threshold:      minimum number of votes (intersections in Hough grid cell)
+        :param min_line_len:   minimum number of pixels to compose line
+        :param max_line_gap:   maximum gap in pixels between line segments
+        :param theta:          angular resolution in radians of the Hough grid
+        :param color_order:    int cv2.COLOR_RGB2GRAY or cv2.COLOR_BGR2GRAY
+        :return: <list> per frame <dict> {left_lane, right_lane, lines, roi_filter_lines, slope_filter_lines}
+        '''
+        assert isinstance(frames, ndarray), 'frames must be <numpy.ndarray>'
+        assert frames.shape[1:] == self.image.shape, 'frames must be a stack of images of the filter shape'
+        assert self.search_mask is None, 'batches are not narrowed to a search mask'
+        if not len(frames):
+            return []
+        [y_height, x_width, channels] = self.image.shape
+        frames = ascontiguousarray(frames)
+        if self._batch_gray is None or len(self._batch_gray) != len(frames):
+            self._batch_gray = zeros((len(frames), y_height, x_width), dtype=uint8)
+        if self._roi_poly is None:
+            self._roi_poly = self.get_roi_poly(self.image, self.roi)
+        stats = self.stats
+        _t = perf_counter()
+        # the stack is one tall image to cvtColor
+        cvtColor(frames.reshape(-1, x_width, channels), color_order,
+                 dst=self._batch_gray.reshape(-1, x_width))
+        _t_gray = perf_counter() - _t
+        _image, _gray, _color_order = self.image, self.gray, self.color_order
+        self.color_order = color_order
+        lines = []
+        try:
+            for _frame, _frame_gray in zip(frames, self._batch_gray):
+                if stats is not None:
+                    stats.start_frame()
+                self.image = _frame
+                self.gray = _frame_gray
+                self.gaussian_blur()
+                self.canny_edges(low_threshold, high_threshold)
+                lines.append(self.hough_lines(rho, threshold, min_line_len, max_line_gap, theta=theta,
+                                              with_lines=False))
+        finally:
+            self.image, self.gray, self.color_order = _image, _gray, _color_order
+            self.image_tf = self._overlay
+        counters = None
+        if stats is not None:
+            counters = stats.frame.counters
+            stats.add_time('grayscale', _t_gray)
+            _t = perf_counter()
+        lower_bound, upper_bound = self.get_lane_bounds()
+        # draw_lines' region mask is the first channel of the ROI masked frame, see get_roi_mask()
+        roi_filter_lines, mean_slope = find_dominate_signals_batch(lines, frames[..., 0], self._roi_poly[..., 0],
+                                                                   counters=counters)
+        if stats is not None:
+            _t = stats.lap('draw_lines.find_dominate_signals', _t)
+        mean_slope = find_mean_slope_batch(roi_filter_lines, mean_slope)
+        if stats is not None:
+            _t = stats.lap('draw_lines.find_mean_slope', _t)
+        slope_filter_lines = interpolate_dominate_lines_batch(roi_filter_lines, mean_slope, lower_bound, upper_bound,
+                                                              x_width - 1, counters=counters)
+        if stats is not None:
+            _t = stats.lap('draw_lines.interpolate_dominate_lines', _t)
+        lanes = fit_lanes_batch(slope_filter_lines, len(frames), lower_bound, upper_bound, method=self.fit_method)
+        if stats is not None:
+            stats.lap('draw_lines.fit_lanes', _t)
+            count(counters, 'lanes', sum((_left is not None) + (_right is not None) for _left, _right in lanes))
+        results = []
+        for _lines, _roi_filter_lines, _slope_filter_lines, (_left, _right) in zip(
+                lines, split_batch(roi_filter_lines, len(frames)), split_batch(slope_filter_lines, len(frames)), lanes):
+            if _right is None:
+                logger.error('did not create right-side lane')
+            if _left is None:
+                logger.error('did not create left-side lane')
+            results.append({
+                'left_lane': _left,
+                'right_lane': _right,
+                'lines': _lines,
+                'roi_filter_lines': _roi_filter_lines,
+                'slope_filter_lines': _slope_filter_lines
+            })
+        if diagnostics.enabled:
+            diagnostics.end_frame(frames=len(frames))
+        return results
+
+    def load_result(self, image: ndarray, result: dict, color_order=COLOR_RGB2GRAY) -> ndarray:
+        '''
+        Loads a frame of the same shape with its detected lanes, e.g. from process_batch(), leaving
+        the filter as after apply_roi_mask(). The frame is not converted to grayscale.
+        :param image: <numpy.ndarray> frame
+        :param result: <dict> {left_lane, right_lane, lines, roi_filter_lines, slope_filter_lines}
+        :param color_order: int cv2.COLOR_RGB2GRAY or cv2.COLOR_BGR2GRAY
+        :return: <numpy.ndarray> overlay
+        '''
+        assert isinstance(image, ndarray), 'image must be <numpy.ndarray>'
+        assert image.shape == self.image.shape, 'images must be same shape, to reuse filter'
+        self.image = image
+        self.color_order = color_order
+        self._roi_current = False
+        self.lines = result['lines']
+        self.roi_filter_lines = result['roi_filter_lines']
+        self.slope_filter_lines = result['slope_filter_lines']
+        self.set_lanes(result['left_lane'], result['right_lane'])
+        self.apply_roi_mask()
+        return self.image_tf
+
+    @timed('weighted_image')
     def weighted_image(self, image_tf=None, α=0.8, β=1., λ=0.) -> ndarray:
         '''
         Matrix Sum, α(image_src) + β(image_tf) + λ
@@ -211,7 +682,13 @@ class LaneFilter(object):
         if image_tf is not None:
             self.image_tf = image_tf
         assert self.image_tf.shape == self.image.shape, 'must be same shape!'
-        self.lane = addWeighted(self.image, α, self.image_tf, β, λ)
+        if self._crop is not None and self.image_tf is self._overlay:
+            # the overlay is empty outside the crop, where the frame is only scaled
+            for _rect in self._crop_outside:
+                convertScaleAbs(self.image[_rect], dst=self.lane[_rect], alpha=α, beta=λ)
+            addWeighted(self.image[self._crop], α, self.image_tf[self._crop], β, λ, dst=self.lane[self._crop])
+            return self.lane
+        self.lane = addWeighted(self.image, α, self.image_tf, β, λ, dst=self.lane)
         return self.lane
 
     def save_image(self, filename: str, image=None, gray=True):
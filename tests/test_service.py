@@ -0,0 +1,87 @@
+import asyncio
+from glob import glob
+from os.path import dirname, join
+from threading import Thread
+import pytest
+from numpy import array_equal, zeros, float32, uint8
+from cv2 import imread, cvtColor, COLOR_BGR2RGB
+from lane_detect.pipeline import LanePipeline
+from lane_detect.service import LaneService, LaneClient
+
+
+TEST_IMAGES = sorted(glob(join(dirname(dirname(__file__)), 'test_images', '*.jpg')))
+
+
+@pytest.fixture(scope='module')
+def images():
+    return [cvtColor(imread(_f), COLOR_BGR2RGB) for _f in TEST_IMAGES]
+
+
+@pytest.fixture(scope='module')
+def service():
+    # the service loop runs in its own thread, the blocking client talks to it over localhost
+    loop = asyncio.new_event_loop()
+    thread = Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    service = LaneService(port=0, max_batch=8, max_wait=0.05)
+    asyncio.run_coroutine_threadsafe(service.start(), loop).result(timeout=10)
+    yield service
+    asyncio.run_coroutine_threadsafe(service.close(), loop).result(timeout=10)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout=10)
+
+
+@pytest.fixture
+def client(service):
+    host, port = service.address
+    with LaneClient(host, port, timeout=30) as client:
+        yield client
+
+
+def assert_lane(actual, expected):
+    if expected is None:
+        assert actual is None
+    else:
+        assert array_equal(actual, expected)
+
+
+def test_pipelined_frames_match_pipeline(service, client, images):
+    pipeline = LanePipeline()
+    expected = []
+    for _image in images:
+        filter = pipeline.detect(_image)
+        expected.append((filter.left_lane, filter.right_lane))
+    _batches = service.batches
+    # each image in both color orders, all in flight at once so they are batched together
+    ids = {}
+    for _i, _image in enumerate(images):
+        ids[client.submit(_image)] = _i
+        ids[client.submit(_image[..., ::-1], color_order='bgr')] = _i
+    for _ in range(len(ids)):
+        result = client.receive()
+        assert 'error' not in result
+        left_lane, right_lane = expected[ids.pop(result['id'])]
+        assert_lane(result['left_lane'], left_lane)
+        assert_lane(result['right_lane'], right_lane)
+    assert not ids
+    assert service.batches - _batches < len(images) * 2
+
+
+def test_overlay(client, images):
+    result = client.detect(images[0], overlay=True)
+    assert 'error' not in result
+    assert result['overlay'].shape == images[0].shape
+    assert result['overlay'].dtype == uint8
+    assert not array_equal(result['overlay'], images[0])
+
+
+def test_errors_keep_the_connection(service, client, images):
+    _errors = service.errors
+    assert 'error' in client.detect(zeros((4, 4), dtype=uint8))
+    assert 'error' in client.detect(zeros((4, 4, 3), dtype=float32))
+    assert 'error' in client.detect(images[0], color_order='hsv')
+    result = client.detect(images[0])
+    assert 'error' not in result
+    stats = client.stats()
+    assert stats['errors'] - _errors == 3
+    assert stats['in_flight'] == 0